@@ -0,0 +1,66 @@
+import time
+import argparse
+import numpy as np
+from RetSys.indexing.build_index import IndexBuilder
+from RetSys.indexing.kv_store import TextType
+
+# Compares the MaxScore-pruned query path with exhaustive BM25 scoring on a saved index.
+# Queries of each length are sampled from the tokens of the index's own keys.
+
+
+def sample_queries(index, length: int, num_queries: int, rng: np.random.Generator, num_keys: int = 1000) -> list:
+    key_indices = rng.choice(len(index.keys), size=min(num_keys, len(index.keys)), replace=False)
+    encoded_keys = index._encode_batch([index.keys[i] for i in key_indices], TextType.KEY, show_progress_bar=False)
+    long_keys = [tokens for tokens in encoded_keys if len(set(tokens)) >= length]
+    if len(long_keys) == 0:
+        return []
+    queries = []
+    for key_idx in rng.integers(0, len(long_keys), size=num_queries):
+        tokens = sorted(set(long_keys[key_idx]))
+        queries.append([tokens[i] for i in rng.choice(len(tokens), size=length, replace=False)])
+    return queries
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark MaxScore pruning against exhaustive BM25 scoring.")
+    parser.add_argument("--index_path", type=str, required=True)
+    parser.add_argument("--top_k", type=int, required=False, default=10)
+    parser.add_argument("--num_queries", type=int, required=False, default=100)
+    parser.add_argument("--query_lengths", type=int, nargs="+", required=False, default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--seed", type=int, required=False, default=0)
+    args = parser.parse_args()
+
+    index = IndexBuilder.load_index(args.index_path)
+    rng = np.random.default_rng(args.seed)
+
+    # "vectorized" scores every posting with numpy, "speedup" is the gain of pruning over it.
+    # "rank_bm25" is the original scorer, only available for indices built in memory.
+    has_rank_bm25 = index.index is not None
+    print(f"{'length':>6} {'rank_bm25 ms':>13} {'vectorized ms':>14} {'pruned ms':>10} {'speedup':>8} {'identical':>10}")
+    for length in args.query_lengths:
+        queries = sample_queries(index, length, args.num_queries, rng)
+        if len(queries) == 0:
+            continue
+        rank_bm25_time, vectorized_time, pruned_time, identical = 0.0, 0.0, 0.0, True
+        for query in queries:
+            if has_rank_bm25:
+                start = time.perf_counter()
+                np.argsort(index.index.get_scores(query))[::-1][: args.top_k]
+                rank_bm25_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            exhaustive = index._query_exhaustive(query, args.top_k)
+            vectorized_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            pruned = index._query(query, args.top_k)
+            pruned_time += time.perf_counter() - start
+            identical &= exhaustive == pruned
+        rank_bm25_ms = f"{rank_bm25_time / len(queries) * 1000:.2f}" if has_rank_bm25 else "-"
+        vectorized_ms = vectorized_time / len(queries) * 1000
+        pruned_ms = pruned_time / len(queries) * 1000
+        print(f"{length:>6} {rank_bm25_ms:>13} {vectorized_ms:>14.2f} {pruned_ms:>10.2f} {vectorized_ms / pruned_ms:>7.1f}x {str(identical):>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,58 @@
+import os
+import time
 import nltk
 import numpy as np
+from collections import Counter
 from tqdm import tqdm
 from rank_bm25 import BM25Okapi
-from typing import List, Tuple, Any
+from typing import List, Tuple, NamedTuple, Any
 from .kv_store import KVStore
 from .kv_store import TextType
+from .kv_store import _link_snapshot_file
+
+POSTINGS_BLOCK_SIZE = 128
+PRUNING_SLACK = 1e-9  # relative margin on pruning thresholds for floating point rounding
+# score exhaustively when the essential postings exceed this fraction of the postings and documents an exhaustive scan touches
+PRUNING_MAX_POSTINGS_FRACTION = 0.1
+
+
+class Postings(NamedTuple):
+    doc_ids: np.ndarray  # sorted document indices
+    scores: np.ndarray  # BM25 score of the term in each document
+    block_last_doc_ids: np.ndarray  # last document index of each block of POSTINGS_BLOCK_SIZE postings
+    block_max_scores: np.ndarray  # maximum score in each block
+
+
+def get_term_postings(doc_ids: np.ndarray, freqs: np.ndarray, idf: float, doc_len: np.ndarray, avgdl: float, k1: float, b: float) -> Postings:
+    """
+    Score the postings of a term and compute the maximum score of each block.
+
+    :param doc_ids: The sorted indices of the documents containing the term.
+    :type doc_ids: np.ndarray
+    :param freqs: The frequency of the term in each document.
+    :type freqs: np.ndarray
+    :param idf: The idf of the term.
+    :type idf: float
+    :param doc_len: The length of each document containing the term.
+    :type doc_len: np.ndarray
+    :param avgdl: The average document length.
+    :type avgdl: float
+    :param k1: The BM25 term frequency saturation.
+    :type k1: float
+    :param b: The BM25 length normalization.
+    :type b: float
+    :return: The postings of the term.
+    :rtype: Postings
+    """
+    # same operations as BM25Okapi.get_scores so the scores are bit-identical
+    scores = idf * (freqs * (k1 + 1) / (freqs + k1 * (1 - b + b * doc_len / avgdl)))
+    block_starts = np.arange(0, len(doc_ids), POSTINGS_BLOCK_SIZE)
+    return Postings(
+        doc_ids=doc_ids,
+        scores=scores,
+        block_last_doc_ids=doc_ids[np.minimum(block_starts + POSTINGS_BLOCK_SIZE, len(doc_ids)) - 1],
+        block_max_scores=np.maximum.reduceat(scores, block_starts),
+    )
 
 
 class BM25(KVStore):
@@ -20,10 +68,21 @@ class BM25(KVStore):
         nltk.download("punkt")
         nltk.download("stopwords")
 
+        self._load_model()
+        self.index = None  # BM25 index
+        self.disk_postings = None  # on-disk postings of indices built out of memory
+        self._postings = None  # term -> Postings, the inverted index with block-max scores, rebuilt on load
+
+    def _load_model(self, device: str = "cuda") -> None:
+        """
+        Load the tokenizer, stop words and stemmer.
+
+        :param device: Unused, BM25 runs on the CPU.
+        :type device: str
+        """
         self._tokenizer = nltk.word_tokenize
         self._stop_words = set(nltk.corpus.stopwords.words("english"))
         self._stemmer = nltk.stem.PorterStemmer().stem
-        self.index = None  # BM25 index
 
     def _encode_batch(
         self, texts: str, type: TextType, show_progress_bar: bool = True
@@ -53,6 +112,83 @@ class BM25(KVStore):
         """
         Query the index.
 
+        Exhaustive BM25 scoring is pruned with MaxScore. The n-th best score of the strongest
+        term alone bounds the final threshold from below, so only the terms whose upper bounds
+        could lift an unseen document past it are scored in full. The other terms are only
+        scored for the surviving candidates, pruned further with per-block upper bounds. The
+        final candidates are rescored in query order, so their scores match
+        ``BM25Okapi.get_scores`` exactly, and ties are broken by the lowest document index. Queries whose essential terms hold a large share of
+        the work of an exhaustive scan are scored exhaustively, since pruning would not pay off.
+
+        :param encoded_query: The encoded query.
+        :type encoded_query: List[str]
+        :param n: The number of results to return.
+        :type n: int
+        :return: The indices of the results.
+        :rtype: List[int]
+        """
+        postings = self._get_postings()
+        term_counts = Counter(term for term in encoded_query if term in postings)
+        if n <= 0 or n >= len(self.keys) or len(term_counts) == 0 or any(self._get_max_score(term) <= 0 for term in term_counts):
+            return self._query_exhaustive(encoded_query, n)
+
+        term_bounds = {term: term_counts[term] * self._get_max_score(term) for term in term_counts}
+        terms = sorted(term_bounds, key=term_bounds.get, reverse=True)
+        remaining_bounds = np.cumsum([term_bounds[term] for term in reversed(terms)])[::-1].tolist() + [0.0]
+
+        # the n-th best contribution of a single term is a lower bound on the final threshold
+        threshold = 0.0
+        for term in terms:
+            if len(postings[term].doc_ids) >= n:
+                threshold = term_counts[term] * np.partition(postings[term].scores, -n)[-n]
+                break
+        if threshold <= 0:
+            # fewer matches than requested
+            return self._query_exhaustive(encoded_query, n)
+
+        num_essential = 1
+        while remaining_bounds[num_essential] >= threshold * (1 - PRUNING_SLACK):
+            num_essential += 1
+        essential_postings = sum(len(postings[term].doc_ids) for term in terms[:num_essential])
+        exhaustive_work = sum(len(postings[term].doc_ids) for term in terms) + len(self.keys)
+        if essential_postings > PRUNING_MAX_POSTINGS_FRACTION * exhaustive_work:
+            return self._query_exhaustive(encoded_query, n)
+
+        # score every posting of the essential terms, unseen documents cannot reach the top n
+        candidates, inverse = np.unique(np.concatenate([postings[term].doc_ids for term in terms[:num_essential]]), return_inverse=True)
+        contributions = np.concatenate([term_counts[term] * postings[term].scores for term in terms[:num_essential]])
+        candidate_scores = np.bincount(inverse.reshape(-1), weights=contributions, minlength=len(candidates))
+        if len(candidate_scores) >= n:
+            threshold = max(threshold, np.partition(candidate_scores, -n)[-n])
+
+        keep = candidate_scores >= threshold * (1 - PRUNING_SLACK) - remaining_bounds[num_essential]
+        candidates, candidate_scores = candidates[keep], candidate_scores[keep]
+        for k in range(num_essential, len(terms)):
+            term_postings = postings[terms[k]]
+            # a candidate survives if the maximum score of its block, plus the bound of the later terms, can reach the threshold
+            keep = candidate_scores + term_counts[terms[k]] * self._get_block_bounds(term_postings, candidates) + remaining_bounds[k + 1] >= threshold * (1 - PRUNING_SLACK)
+            candidates, candidate_scores = candidates[keep], candidate_scores[keep]
+            candidate_scores += term_counts[terms[k]] * self._lookup_scores(term_postings, candidates)
+            if len(candidate_scores) > n:
+                threshold = max(threshold, np.partition(candidate_scores, -n)[-n])
+        candidates = candidates[candidate_scores >= threshold * (1 - PRUNING_SLACK)]
+
+        # rescore in query order to reproduce the exhaustive floating point sums
+        exact_scores = np.zeros(len(candidates))
+        for term in encoded_query:
+            if term in postings:
+                exact_scores += self._lookup_scores(postings[term], candidates)
+        if np.count_nonzero(exact_scores > 0) < n:
+            # fewer matches than requested, fill with the same zero-score documents as exhaustive scoring
+            return self._query_exhaustive(encoded_query, n)
+        # same order as exhaustive scoring: best score first, then lowest document index
+        order = np.lexsort((candidates, -exact_scores))[:n]
+        return candidates[order].tolist()
+
+    def _query_exhaustive(self, encoded_query: List[str], n: int) -> List[int]:
+        """
+        Query the index by scoring every document.
+
         :param encoded_query: The encoded query.
         :type encoded_query: List[str]
         :param n: The number of results to return.
@@ -60,10 +196,159 @@ class BM25(KVStore):
         :return: The indices of the results.
         :rtype: List[int]
         """
-        scores = self.index.get_scores(encoded_query)
-        sorted_indices = np.argsort(scores)[::-1]  # Sort once and store
-        top_indices = sorted_indices[:n].tolist()
-        return top_indices
+        return self._get_top_indices(self._get_scores(encoded_query), n)
+
+    @staticmethod
+    def _get_top_indices(scores: np.ndarray, n: int) -> List[int]:
+        """
+        Get the indices of the n highest scores, best first, without sorting every score.
+
+        Ties are broken by the lowest index, so the results do not depend on how they were found.
+
+        :param scores: The scores of every document.
+        :type scores: np.ndarray
+        :param n: The number of results to return.
+        :type n: int
+        :return: The indices of the results.
+        :rtype: List[int]
+        """
+        if n <= 0:
+            return []
+        if n >= len(scores):
+            return np.lexsort((np.arange(len(scores)), -scores)).tolist()
+        nth_score = np.partition(scores, -n)[-n]
+        above = np.flatnonzero(scores > nth_score)
+        top_indices = np.concatenate([above, np.flatnonzero(scores == nth_score)[: n - len(above)]])
+        return top_indices[np.lexsort((top_indices, -scores[top_indices]))].tolist()
+
+    def _get_scores(self, encoded_query: List[str]) -> np.ndarray:
+        """
+        Score every document, adding the terms in query order like ``BM25Okapi.get_scores``.
+
+        :param encoded_query: The encoded query.
+        :type encoded_query: List[str]
+        :return: The scores of every document.
+        :rtype: np.ndarray
+        """
+        postings = self._get_postings()
+        scores = np.zeros(len(self.keys))
+        for term in encoded_query:
+            if term in postings:
+                scores[postings[term].doc_ids] += postings[term].scores
+        return scores
+
+    @staticmethod
+    def _lookup_scores(term_postings: "Postings", doc_ids: np.ndarray) -> np.ndarray:
+        """
+        Look up the scores of a term for the given documents, 0 where the term does not occur.
+
+        :param term_postings: The postings of the term.
+        :type term_postings: Postings
+        :param doc_ids: The document indices.
+        :type doc_ids: np.ndarray
+        :return: The scores of the term in each document.
+        :rtype: np.ndarray
+        """
+        positions = np.minimum(np.searchsorted(term_postings.doc_ids, doc_ids), len(term_postings.doc_ids) - 1)
+        found = term_postings.doc_ids[positions] == doc_ids
+        return np.where(found, term_postings.scores[positions], 0.0)
+
+    @staticmethod
+    def _get_block_bounds(term_postings: "Postings", doc_ids: np.ndarray) -> np.ndarray:
+        """
+        Get an upper bound on the scores of a term for the given documents: the maximum score of
+        the postings block each document falls in, 0 past the last block.
+
+        :param term_postings: The postings of the term.
+        :type term_postings: Postings
+        :param doc_ids: The sorted document indices.
+        :type doc_ids: np.ndarray
+        :return: The bound of the term in each document.
+        :rtype: np.ndarray
+        """
+        blocks = np.searchsorted(term_postings.block_last_doc_ids, doc_ids)
+        bounded_scores = np.append(term_postings.block_max_scores, 0.0)
+        return bounded_scores[blocks]
+
+    def _get_postings(self) -> dict:
+        """
+        Get the inverted index: the precomputed BM25 score of every term in every document, sorted
+        by document, with the maximum score of each block of postings.
+
+        :return: The postings of each term.
+        :rtype: dict
+        """
+        if self.disk_postings is not None:
+            return self.disk_postings
+        if self._postings is None:
+            doc_ids, term_freqs = {}, {}
+            for doc_id, doc_freqs in enumerate(self.index.doc_freqs):
+                for term, freq in doc_freqs.items():
+                    doc_ids.setdefault(term, []).append(doc_id)
+                    term_freqs.setdefault(term, []).append(freq)
+
+            doc_len = np.array(self.index.doc_len)
+            k1, b = self.index.k1, self.index.b
+            postings = {}
+            for term, term_doc_ids in doc_ids.items():
+                term_doc_ids = np.array(term_doc_ids, dtype=np.int64)
+                postings[term] = get_term_postings(
+                    term_doc_ids, np.array(term_freqs[term]), self.index.idf[term], doc_len[term_doc_ids], self.index.avgdl, k1, b
+                )
+            self._postings = postings
+        return self._postings
+
+    def _get_max_score(self, term: str) -> float:
+        """
+        Get the maximum score of a term in any document. On-disk postings store it, so the
+        postings of the term are not decoded.
+
+        :param term: The term.
+        :type term: str
+        :return: The maximum score.
+        :rtype: float
+        """
+        if self.disk_postings is not None:
+            return self.disk_postings.get_max_score(term)
+        return self._get_postings()[term].block_max_scores.max()
+
+    def _get_scores_budgeted(self, encoded_query: List[str], deadline: float) -> Tuple[np.ndarray, bool]:
+        """
+        Score the documents term by term, highest-impact terms first, until the deadline passes.
+
+        :param encoded_query: The encoded query.
+        :type encoded_query: List[str]
+        :param deadline: The ``time.perf_counter()`` value by which to return.
+        :type deadline: float
+        :return: The scores of every document, and whether some terms were skipped.
+        :rtype: Tuple[np.ndarray, bool]
+        """
+        postings = self._get_postings()
+        term_counts = Counter(term for term in encoded_query if term in postings)
+        terms = sorted(term_counts, key=lambda term: term_counts[term] * self._get_max_score(term), reverse=True)
+
+        scores = np.zeros(len(self.keys))
+        for rank, term in enumerate(terms):
+            if rank > 0 and time.perf_counter() >= deadline:
+                return scores, True
+            scores[postings[term].doc_ids] += term_counts[term] * postings[term].scores
+        return scores, False
+
+    def _query_budgeted(self, encoded_query: List[str], n: int, deadline: float) -> Tuple[List[int], bool]:
+        """
+        Query the index, skipping the lowest-impact query terms once the deadline has passed.
+
+        :param encoded_query: The encoded query.
+        :type encoded_query: List[str]
+        :param n: The number of results to return.
+        :type n: int
+        :param deadline: The ``time.perf_counter()`` value by which to return.
+        :type deadline: float
+        :return: The indices of the results, and whether the search stopped early.
+        :rtype: Tuple[List[int], bool]
+        """
+        scores, partial = self._get_scores_budgeted(encoded_query, deadline)
+        return self._get_top_indices(scores, n), partial
 
     def clear(self) -> None:
         """
@@ -71,16 +356,67 @@ class BM25(KVStore):
         """
         super().clear()
         self.index = None
+        self.disk_postings = None
+        self._postings = None
 
-    def create_index(self, key_value_pairs: List[Tuple[str, Any]]) -> None:
+    def create_index(self, key_value_pairs: List[Tuple[str, Any]], checkpoint_dir: str = None, chunk_size: int = 50000, num_workers: int = 1,
+                     postings_path: str = None, memory_budget_mb: float = 1024) -> None:
         """
         Create the index.
 
+        With a postings path, the encoded keys are streamed chunk by chunk into an external-memory
+        build that writes compressed postings to that file, and are not kept in memory. The
+        postings file must stay at that path for an index saved with ``save()`` to be loaded,
+        ``save_snapshot()`` gives each snapshot its own copy.
+
         :param key_value_pairs: The key-value pairs to create the index from.
         :type key_value_pairs: List[Tuple[str, Any]]
+        :param checkpoint_dir: The directory to write encoded chunks to.
+        :type checkpoint_dir: str, optional
+        :param chunk_size: The number of keys per chunk.
+        :type chunk_size: int
+        :param num_workers: The number of worker processes encoding chunks.
+        :type num_workers: int
+        :param postings_path: The path of the on-disk postings file to build.
+        :type postings_path: str, optional
+        :param memory_budget_mb: The memory for postings accumulated before spilling a sorted run to disk, in megabytes.
+        :type memory_budget_mb: float
         """
-        super().create_index(key_value_pairs)
-        self.index = BM25Okapi(self.encoded_keys)
+        if postings_path is None:
+            super().create_index(key_value_pairs, checkpoint_dir, chunk_size, num_workers)
+            self.index = BM25Okapi(self.encoded_keys)
+            self._get_postings()
+            return
+
+        from .spimi import build_postings
+
+        self._add_key_value_pairs(key_value_pairs)
+        chunks = self._iter_encoded_chunks(checkpoint_dir, chunk_size, num_workers)
+        self.disk_postings = build_postings((document for chunk in chunks for document in chunk), postings_path, memory_budget_mb)
+
+    def _save_snapshot_files(self, snapshot_dir: str, version: int) -> None:
+        """
+        Give the snapshot its own copy of the on-disk postings, so rebuilding never changes the
+        postings an older snapshot reads.
+
+        The postings are hard-linked, or copied across file systems. A hidden build file in the
+        snapshot directory is removed afterwards.
+
+        :param snapshot_dir: The snapshot directory.
+        :type snapshot_dir: str
+        :param version: The version of the new snapshot.
+        :type version: int
+        """
+        if self.disk_postings is None:
+            return
+        source_path = self.disk_postings.postings_path
+        postings_path = os.path.abspath(os.path.join(snapshot_dir, f"{version:06d}.postings"))
+        if source_path == postings_path:
+            return
+        _link_snapshot_file(source_path, postings_path)
+        self.disk_postings.move(postings_path)
+        if os.path.dirname(source_path) == os.path.dirname(postings_path) and os.path.basename(source_path).startswith("."):
+            os.remove(source_path)
 
     def load(self, dir_name: str) -> None:
         """
@@ -90,7 +426,9 @@ class BM25(KVStore):
         :type dir_name: str
         """
         super().load(dir_name)
-        self._tokenizer = nltk.word_tokenize
-        self._stop_words = set(nltk.corpus.stopwords.words("english"))
-        self._stemmer = nltk.stem.PorterStemmer().stem
+        self._load_model()
+        # build the postings now rather than on the first query
+        self._postings = None
+        if self.index is not None:
+            self._get_postings()
         return self
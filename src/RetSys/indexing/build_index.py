@@ -1,13 +1,19 @@
 import os
 import argparse
 import datasets
-from typing import List
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from typing import List, Tuple, Any
 from . import utils
+from . import dedup
 from .kv_store import KVStore
+from .kv_store import get_latest_snapshot
 
 
 class IndexBuilder:
-    def __init__(self, index_type: str, index_name: str, save_dir: str, granularity: str = "paragraphs"):
+    def __init__(self, index_type: str, index_name: str, save_dir: str, granularity: str = "paragraphs",
+                 deduplicate: bool = False, dedup_threshold: float = 0.8):
         """
         Initialize the IndexBuilder class.
 
@@ -18,12 +24,22 @@ class IndexBuilder:
         :param save_dir: The directory to save the index.
         :type save_dir: str
         :param granularity: The granularity of the index.
-        :type granularity: str, defaults to "paragraphs"
+        :type granularity: str, defaults to "paragraphs", one of "paragraphs", "propositions" or "hierarchical"
+        :param deduplicate: Whether to collapse near-duplicate keys, keeping every location as the value.
+        :type deduplicate: bool, defaults to False
+        :param dedup_threshold: The Jaccard similarity above which keys are near-duplicates.
+        :type dedup_threshold: float, defaults to 0.8
+        :raises ValueError: If deduplication is requested with "hierarchical" granularity.
         """
+        if deduplicate and granularity == "hierarchical":
+            raise ValueError("Deduplication is not supported with 'hierarchical' granularity")
         self.index_type = index_type
         self.index_name = index_name
         self.granularity = granularity
         self.save_dir = save_dir
+        self.deduplicate = deduplicate
+        self.dedup_threshold = dedup_threshold
+        self.dedup_stats = None
         self.index = self.initialize_index()
     def initialize_index(self) -> KVStore:
         """
@@ -58,6 +74,16 @@ class IndexBuilder:
             from .gtr import GTR
 
             index = GTR(self.index_name)
+        elif self.index_type == "twostage":
+            from .two_stage import TwoStage
+
+            index = TwoStage(self.index_name)
+        elif self.index_type == "hierarchical":
+            from .hierarchical import Hierarchical
+
+            if self.granularity != "hierarchical":
+                raise ValueError("Hierarchical indices require 'hierarchical' granularity")
+            index = Hierarchical(self.index_name)
         else:
             raise ValueError("Invalid index type")
         return index
@@ -71,32 +97,134 @@ class IndexBuilder:
         :return: The key-value pairs.
         :rtype: dict
         """
+        if self.granularity == "hierarchical":
+            # each paragraph maps to its location and its propositions
+            kv_pairs = {}
+            paragraph_propositions = utils.get_clean_paragraph_propositions(data)
+            for i, record in enumerate(data):
+                corpusid = utils.get_clean_corpusid(record)
+                for paragraph_idx, (paragraph, propositions) in enumerate(paragraph_propositions[i]):
+                    kv_pairs[paragraph] = ((corpusid, paragraph_idx), propositions)
+            return kv_pairs
+
         if self.granularity == "propositions":
             kv_pairs = {}
             propositions = utils.get_clean_propositions(data)  # load libraries once
             for i, record in enumerate(data):
                 corpusid = utils.get_clean_corpusid(record)
                 for proposition_idx, proposition in enumerate(propositions[i]):
-                    kv_pairs[proposition] = (corpusid, proposition_idx)
+                    self._add_kv_pair(kv_pairs, proposition, (corpusid, proposition_idx))
         elif self.granularity == "paragraphs":
             kv_pairs = {}
             for record in data:
                 corpusid = utils.get_clean_corpusid(record)
                 paragraphs = utils.get_clean_paragraphs(record)
                 for paragraph_idx, paragraph in enumerate(paragraphs):
-                    kv_pairs[paragraph] = (corpusid, paragraph_idx)
-        
+                    self._add_kv_pair(kv_pairs, paragraph, (corpusid, paragraph_idx))
+
+        if self.deduplicate:
+            kv_pairs = self._deduplicate(kv_pairs)
+        return kv_pairs
+
+    def create_kv_columns(self, data: datasets.Dataset, num_proc: int = None, batch_size: int = 1000) -> Tuple[List[str], List[Any]]:
+        """
+        Create the keys and values of the index as parallel columns.
+
+        Paragraphs are split with batched, Arrow-backed ``Dataset.map`` calls and identical
+        paragraphs are collapsed in Arrow (the last location wins, as in ``create_kv_pairs``),
+        so no intermediate key-value dict is built unless deduplicating.
+
+        :param data: The data to create the columns from.
+        :type data: datasets.Dataset
+        :param num_proc: The number of processes used to split the records.
+        :type num_proc: int, optional
+        :param batch_size: The number of records per batch.
+        :type batch_size: int
+        :return: The keys and their values.
+        :rtype: Tuple[List[str], List[Any]]
+        """
+        if self.granularity != "paragraphs":
+            kv_pairs = self.create_kv_pairs(data)
+            return list(kv_pairs.keys()), list(kv_pairs.values())
+
+        chunks = data.map(
+            utils.get_clean_paragraph_columns,
+            batched=True,
+            batch_size=batch_size,
+            num_proc=num_proc,
+            remove_columns=data.column_names,
+            desc="Splitting paragraphs",
+        )
+        table = chunks.with_format("arrow")[:]
+
+        if self.deduplicate:
+            kv_pairs = {}
+            for key, corpusid, position in zip(table["key"].to_pylist(), table["corpusid"].to_pylist(), table["position"].to_pylist()):
+                self._add_kv_pair(kv_pairs, key, (corpusid, position))
+            kv_pairs = self._deduplicate(kv_pairs)
+            return list(kv_pairs.keys()), list(kv_pairs.values())
+
+        # keep the first occurrence's order and the last occurrence's location
+        table = table.append_column("row", pa.array(np.arange(len(table), dtype=np.int64)))
+        grouped = table.group_by("key").aggregate([("row", "min"), ("row", "max")])
+        grouped = grouped.take(pc.sort_indices(grouped, sort_keys=[("row_min", "ascending")]))
+        table = table.take(grouped["row_max"])
+
+        keys = table["key"].to_pylist()
+        values = list(zip(table["corpusid"].to_pylist(), table["position"].to_pylist()))
+        return keys, values
+
+    def _deduplicate(self, kv_pairs: dict) -> dict:
+        """
+        Collapse near-duplicate keys and record the stats.
+
+        :param kv_pairs: The keys mapped to their list of locations.
+        :type kv_pairs: dict
+        :return: The deduplicated key-value pairs.
+        :rtype: dict
+        """
+        kv_pairs, self.dedup_stats = dedup.deduplicate_kv_pairs(kv_pairs, self.dedup_threshold)
+        print(
+            f"Deduplicated {self.dedup_stats['num_locations']} keys into {self.dedup_stats['num_keys']} "
+            f"({self.dedup_stats['num_removed']} removed, {self.dedup_stats['num_near_duplicates_removed']} of them near-duplicates, "
+            f"{self.dedup_stats['num_clusters']} clusters)"
+        )
         return kv_pairs
-    def load_index(self, index_path: str) -> KVStore:
+
+    def _add_kv_pair(self, kv_pairs: dict, key: str, location: tuple) -> None:
+        """
+        Add a key and its location to the key-value pairs.
+
+        When deduplicating, every location of a repeated key is kept, otherwise the last one wins.
+
+        :param kv_pairs: The key-value pairs.
+        :type kv_pairs: dict
+        :param key: The key.
+        :type key: str
+        :param location: The corpus id and position of the key.
+        :type location: tuple
+        """
+        if self.deduplicate:
+            kv_pairs.setdefault(key, []).append(location)
+        else:
+            kv_pairs[key] = location
+    @staticmethod
+    def load_index(index_path: str) -> KVStore:
         """
         Load an existing index from disk.
 
-        :param index_path: The path to the index.
+        :param index_path: The path to the index, or to a snapshot directory to load its published snapshot.
         :type index_path: str
         :raises ValueError: If the index type is not valid.
+        :raises ValueError: If the snapshot directory has no published snapshot.
         :return: The index.
         :rtype: KVStore
         """
+        if os.path.isdir(index_path):
+            snapshot_path = get_latest_snapshot(index_path)
+            if snapshot_path is None:
+                raise ValueError(f"No snapshot published in {index_path}")
+            index_path = snapshot_path
         index_type = os.path.basename(index_path).split(".")[-1]
         if index_type == "bm25":
             from .bm25 import BM25
@@ -114,6 +242,18 @@ class IndexBuilder:
             from .gtr import GTR
 
             index = GTR(None).load(index_path)
+        elif index_type == "twostage":
+            from .two_stage import TwoStage
+
+            index = TwoStage(None).load(index_path)
+        elif index_type == "hierarchical":
+            from .hierarchical import Hierarchical
+
+            index = Hierarchical(None).load(index_path)
+        elif index_type == "grit":
+            from .grit import GRIT
+
+            index = GRIT(None, None).load(index_path)
         else:
             raise ValueError("Invalid index type")
         return index
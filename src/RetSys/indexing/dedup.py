@@ -0,0 +1,142 @@
+import zlib
+import numpy as np
+from collections import defaultdict
+from tqdm import tqdm
+from typing import List, Tuple
+
+_MERSENNE_PRIME = (1 << 31) - 1
+LSH_MIN_RECALL = 0.9  # probability that a pair exactly at the threshold becomes a candidate
+
+##### near-duplicate detection with MinHash and LSH #####
+
+
+def get_shingles(text: str, shingle_size: int = 3) -> List[str]:
+    words = text.lower().split()
+    if len(words) <= shingle_size:
+        return [" ".join(words)]
+    return [" ".join(words[i : i + shingle_size]) for i in range(len(words) - shingle_size + 1)]
+
+
+def get_lsh_params(num_perm: int, threshold: float, min_recall: float = LSH_MIN_RECALL) -> Tuple[int, int]:
+    """
+    Choose the number of bands and rows per band with the fewest candidates that still find most pairs at the threshold.
+
+    Candidates are verified against the threshold afterwards, so the bands favour recall: the
+    S-curve ``1 - (1 - s^rows)^bands`` must reach ``min_recall`` at the threshold, and among those
+    the most rows per band keep the fewest dissimilar candidates.
+
+    :param num_perm: The number of MinHash permutations.
+    :type num_perm: int
+    :param threshold: The target Jaccard similarity.
+    :type threshold: float
+    :param min_recall: The probability that a pair at the threshold shares a band.
+    :type min_recall: float
+    :return: The number of bands and rows per band.
+    :rtype: Tuple[int, int]
+    """
+    candidates = [(num_perm // rows, rows) for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+    recalled = [(bands, rows) for bands, rows in candidates if 1 - (1 - threshold**rows) ** bands >= min_recall]
+    return max(recalled, key=lambda params: params[1]) if len(recalled) > 0 else candidates[0]
+
+
+def get_minhashes(texts: List[str], num_perm: int = 128, shingle_size: int = 3, seed: int = 0) -> np.ndarray:
+    """
+    Compute the MinHash signature of each text.
+
+    :param texts: The texts to hash.
+    :type texts: List[str]
+    :param num_perm: The number of permutations.
+    :type num_perm: int
+    :param shingle_size: The number of words per shingle.
+    :type shingle_size: int
+    :param seed: The seed of the permutations.
+    :type seed: int
+    :return: The signatures, one row per text.
+    :rtype: np.ndarray
+    """
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, _MERSENNE_PRIME, size=(num_perm, 1), dtype=np.uint64)
+    b = rng.randint(0, _MERSENNE_PRIME, size=(num_perm, 1), dtype=np.uint64)
+    signatures = np.empty((len(texts), num_perm), dtype=np.uint32)
+    for i, text in enumerate(tqdm(texts, desc="Computing MinHash signatures")):
+        hashes = np.array([zlib.crc32(shingle.encode("utf-8")) for shingle in get_shingles(text, shingle_size)], dtype=np.uint64)
+        hashes %= _MERSENNE_PRIME
+        signatures[i] = ((a * hashes + b) % _MERSENNE_PRIME).min(axis=1)
+    return signatures
+
+
+def find_clusters(signatures: np.ndarray, threshold: float) -> List[int]:
+    """
+    Cluster texts whose estimated Jaccard similarity reaches the threshold.
+
+    :param signatures: The MinHash signatures.
+    :type signatures: np.ndarray
+    :param threshold: The Jaccard similarity above which texts are near-duplicates.
+    :type threshold: float
+    :return: The index of the representative of each text's cluster, the earliest text in the cluster.
+    :rtype: List[int]
+    """
+    parents = list(range(len(signatures)))
+
+    def find(i: int) -> int:
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    bands, rows = get_lsh_params(signatures.shape[1], threshold)
+    for band in range(bands):
+        buckets = defaultdict(list)
+        for i, band_signature in enumerate(signatures[:, band * rows : (band + 1) * rows]):
+            buckets[band_signature.tobytes()].append(i)
+        for bucket in buckets.values():
+            # one earlier member of each distinct cluster in the bucket, repeated boilerplate keeps this short
+            representatives = [bucket[0]]
+            for i in bucket[1:]:
+                root_i = find(i)
+                others = np.array([j for j in representatives if find(j) != root_i], dtype=np.int64)
+                if len(others) > 0:
+                    # LSH only proposes candidates, check the estimated similarity before merging
+                    for j in others[np.mean(signatures[others] == signatures[i], axis=1) >= threshold]:
+                        root_i, root_j = find(i), find(j)
+                        if root_i != root_j:
+                            parents[max(root_i, root_j)] = min(root_i, root_j)
+                clusters = {}
+                for j in representatives + [i]:
+                    clusters.setdefault(find(j), j)
+                representatives = list(clusters.values())
+    return [find(i) for i in range(len(signatures))]
+
+
+def deduplicate_kv_pairs(kv_pairs: dict, threshold: float = 0.8, num_perm: int = 128, shingle_size: int = 3) -> Tuple[dict, dict]:
+    """
+    Collapse near-duplicate keys into one representative per cluster.
+
+    :param kv_pairs: The keys mapped to their list of locations.
+    :type kv_pairs: dict
+    :param threshold: The Jaccard similarity above which keys are near-duplicates.
+    :type threshold: float
+    :param num_perm: The number of MinHash permutations.
+    :type num_perm: int
+    :param shingle_size: The number of words per shingle.
+    :type shingle_size: int
+    :return: The representative keys mapped to the locations of their whole cluster, and stats on what was removed.
+    :rtype: Tuple[dict, dict]
+    """
+    keys = list(kv_pairs.keys())
+    representatives = find_clusters(get_minhashes(keys, num_perm, shingle_size), threshold)
+
+    deduplicated = {}
+    for key, representative in zip(keys, representatives):
+        deduplicated.setdefault(keys[representative], []).extend(kv_pairs[key])
+
+    num_locations = sum(len(locations) for locations in kv_pairs.values())
+    stats = {
+        "num_locations": num_locations,
+        "num_unique_keys": len(keys),
+        "num_keys": len(deduplicated),
+        "num_removed": num_locations - len(deduplicated),
+        "num_near_duplicates_removed": len(keys) - len(deduplicated),
+        "num_clusters": sum(1 for locations in deduplicated.values() if len(locations) > 1),
+    }
+    return deduplicated, stats
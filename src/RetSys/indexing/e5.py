@@ -1,16 +1,25 @@
 import sentence_transformers
 import numpy as np
-from typing import List, Any
+from typing import List, Tuple, Any
 from sklearn.metrics.pairwise import cosine_similarity
 from .kv_store import KVStore
 from .kv_store import TextType
 from . import utils
+from . import pca
+from . import partitions
 
 class E5(KVStore):
-    def __init__(self, index_name: str, model_path: str = "intfloat/e5-large-v2"):
+    def __init__(self, index_name: str, model_path: str = "intfloat/e5-large-v2", pca_components: int = None, rescore_size: int = 500, device: str = "cuda"):
         super().__init__(index_name, 'e5')
         self.model_path = model_path
-        self._model = sentence_transformers.SentenceTransformer(model_path, device="cuda", cache_folder=utils.get_cache_dir()).bfloat16()
+        self.pca_components = pca_components  # dimensions of the first-pass scan, None for a full scan
+        self.rescore_size = rescore_size
+        self.projection = None
+        self.partitions = None  # k-means partitions for latency-budgeted queries
+        self._load_model(device)
+
+    def _load_model(self, device: str = "cuda") -> None:
+        self._model = sentence_transformers.SentenceTransformer(self.model_path, device=device, cache_folder=utils.get_cache_dir()).bfloat16()
     
     def _format_text(self, text: str, type: TextType) -> str:
         if type == TextType.KEY:
@@ -24,14 +33,44 @@ class E5(KVStore):
     def _encode_batch(self, texts: List[str], type: TextType, show_progress_bar: bool = True) -> List[Any]:
         texts = [self._format_text(text, type) for text in texts]
         return self._model.encode(texts, batch_size=256, normalize_embeddings=True, show_progress_bar=show_progress_bar).astype(np.float16)
+
+    def _get_encoder_config(self) -> dict:
+        return {"model_path": self.model_path}
     
     def _query(self, encoded_query: Any, n: int) -> List[int]:
-        cosine_similarities = cosine_similarity([encoded_query], self.encoded_keys)[0]
+        if self.projection is not None:
+            return pca.coarse_to_fine_query(encoded_query, self.encoded_keys, self.projection, n, self.rescore_size)
+        cosine_similarities = self._get_scores(encoded_query)
         top_indices = cosine_similarities.argsort()[-n:][::-1]
         return top_indices
+
+    def _get_scores(self, encoded_query: Any) -> np.ndarray:
+        return cosine_similarity([encoded_query], self.encoded_keys)[0]
+    
+    def _query_budgeted(self, encoded_query: Any, n: int, deadline: float) -> Tuple[List[int], bool]:
+        if self.partitions is None:
+            return super()._query_budgeted(encoded_query, n, deadline)
+        return partitions.budgeted_query(encoded_query, self.encoded_keys, self.partitions, n, deadline)
+
+    def fit_partitions(self, num_partitions: int = None) -> None:
+        self.partitions = partitions.fit_partitions(self.encoded_keys, num_partitions)
+
+    def fit_pca(self, n_components: int) -> None:
+        self.pca_components = n_components
+        self.projection = pca.fit_projection(self.encoded_keys, n_components)
+
+    def clear(self) -> None:
+        super().clear()
+        self.projection = None
+        self.partitions = None
+
+    def create_index(self, key_value_pairs: List[Tuple[str, Any]], checkpoint_dir: str = None, chunk_size: int = 50000, num_workers: int = 1) -> None:
+        super().create_index(key_value_pairs, checkpoint_dir, chunk_size, num_workers)
+        if self.pca_components is not None:
+            self.fit_pca(self.pca_components)
     
     def load(self, path: str):
         super().load(path)
-        self._model = sentence_transformers.SentenceTransformer(self.model_path, device="cuda", cache_folder=utils.get_cache_dir())
+        self._load_model()
         return self
         
@@ -10,7 +10,11 @@ class GRIT(KVStore):
         super().__init__(index_name, 'grit')
         self.model_path = model_path
         self.raw_instruction = raw_instruction
-        self._model = GritLM(model_path, torch_dtype="auto", device_map="auto", mode="embedding")
+        self._load_model()
+
+    def _load_model(self, device: str = "cuda") -> None:
+        device_map = "auto" if device == "cuda" else device
+        self._model = GritLM(self.model_path, torch_dtype="auto", device_map=device_map, mode="embedding")
     
     def _get_instruction(self, type: TextType) -> str:
         if type == TextType.KEY:
@@ -22,20 +26,26 @@ class GRIT(KVStore):
     
     def _encode_batch(self, texts: List[str], type: TextType, show_progress_bar: bool = True) -> List[Any]:
         return self._model.encode(texts, batch_size=256, instruction=self._get_instruction(type), show_progress_bar=show_progress_bar).astype(np.float16)
+
+    def _get_encoder_config(self) -> dict:
+        return {"model_path": self.model_path}
     
     def _query(self, encoded_query: Any, n: int) -> List[int]:
+        cosine_similarities = self._get_scores(encoded_query)
+        top_indices = cosine_similarities.argsort()[-n:][::-1]
+        return top_indices
+
+    def _get_scores(self, encoded_query: Any) -> np.ndarray:
         try:
-            cosine_similarities = cosine_similarity([encoded_query], self.encoded_keys)[0]
+            return cosine_similarity([encoded_query], self.encoded_keys)[0]
         except:
             for i, encoded_key in enumerate(self.encoded_keys):
                 if np.any(np.isnan(encoded_key)):
                     self.encoded_keys[i] = np.zeros_like(encoded_key)
-            cosine_similarities = cosine_similarity([encoded_query], self.encoded_keys)[0]
-        top_indices = cosine_similarities.argsort()[-n:][::-1]
-        return top_indices
+            return cosine_similarity([encoded_query], self.encoded_keys)[0]
     
     def load(self, path: str):
         super().load(path)
-        self._model = GritLM(self.model_path, torch_dtype="auto", device_map="auto", mode="embedding")
+        self._load_model()
         return self
         
@@ -1,19 +1,34 @@
 import sentence_transformers
 import numpy as np
-from typing import List, Any
+from typing import List, Tuple, Any
 from sklearn.metrics.pairwise import cosine_similarity
 from .kv_store import KVStore
 from .kv_store import TextType
 from . import utils
+from . import pca
+from . import partitions
 
 class GTR(KVStore):
     """
     GTR index class.
     """
-    def __init__(self, index_name: str, model_path: str = "sentence-transformers/gtr-t5-large"):
+    def __init__(self, index_name: str, model_path: str = "sentence-transformers/gtr-t5-large", pca_components: int = None, rescore_size: int = 500, device: str = "cuda"):
         super().__init__(index_name, 'gtr')
         self.model_path = model_path
-        self._model = sentence_transformers.SentenceTransformer(model_path, device="cuda", cache_folder=utils.get_cache_dir())
+        self.pca_components = pca_components  # dimensions of the first-pass scan, None for a full scan
+        self.rescore_size = rescore_size
+        self.projection = None
+        self.partitions = None  # k-means partitions for latency-budgeted queries
+        self._load_model(device)
+
+    def _load_model(self, device: str = "cuda") -> None:
+        """
+        Load the sentence-transformers model.
+
+        :param device: The device to load the model on.
+        :type device: str
+        """
+        self._model = sentence_transformers.SentenceTransformer(self.model_path, device=device, cache_folder=utils.get_cache_dir())
     
     def _encode_batch(self, texts: List[str], type: TextType, show_progress_bar: bool = True) -> List[Any]:
         """
@@ -29,6 +44,15 @@ class GTR(KVStore):
         :rtype: List[Any]
         """
         return self._model.encode(texts, batch_size=256, show_progress_bar=show_progress_bar).astype(np.float16)
+
+    def _get_encoder_config(self) -> dict:
+        """
+        Get the settings that determine how keys are encoded.
+
+        :return: The encoder settings.
+        :rtype: dict
+        """
+        return {"model_path": self.model_path}
     
     def _query(self, encoded_query: Any, n: int) -> List[int]:
         """
@@ -41,9 +65,86 @@ class GTR(KVStore):
         :return: The indices of the results.
         :rtype: List[int]
         """
-        cosine_similarities = cosine_similarity([encoded_query], self.encoded_keys)[0]
+        if self.projection is not None:
+            return pca.coarse_to_fine_query(encoded_query, self.encoded_keys, self.projection, n, self.rescore_size)
+        cosine_similarities = self._get_scores(encoded_query)
         top_indices = cosine_similarities.argsort()[-n:][::-1]
         return top_indices
+
+    def _get_scores(self, encoded_query: Any) -> np.ndarray:
+        """
+        Score every key by cosine similarity.
+
+        :param encoded_query: The encoded query.
+        :type encoded_query: Any
+        :return: The score of each key.
+        :rtype: np.ndarray
+        """
+        return cosine_similarity([encoded_query], self.encoded_keys)[0]
+    
+    def _query_budgeted(self, encoded_query: Any, n: int, deadline: float) -> Tuple[List[int], bool]:
+        """
+        Query the index, scanning partitions by decreasing centroid similarity until the deadline.
+
+        :param encoded_query: The encoded query.
+        :type encoded_query: Any
+        :param n: The number of results to return.
+        :type n: int
+        :param deadline: The ``time.perf_counter()`` value by which to return.
+        :type deadline: float
+        :return: The indices of the results, and whether the search stopped early.
+        :rtype: Tuple[List[int], bool]
+        """
+        if self.partitions is None:
+            return super()._query_budgeted(encoded_query, n, deadline)
+        return partitions.budgeted_query(encoded_query, self.encoded_keys, self.partitions, n, deadline)
+
+    def fit_partitions(self, num_partitions: int = None) -> None:
+        """
+        Cluster the encoded keys into partitions for latency-budgeted queries.
+
+        :param num_partitions: The number of partitions, defaults to the square root of the number of keys.
+        :type num_partitions: int, optional
+        """
+        self.partitions = partitions.fit_partitions(self.encoded_keys, num_partitions)
+
+    def fit_pca(self, n_components: int) -> None:
+        """
+        Fit a PCA projection on the encoded keys for coarse-to-fine search.
+
+        Queries first scan the reduced keys, then rescore the top ``rescore_size``
+        candidates with the full keys.
+
+        :param n_components: The number of dimensions of the reduced keys.
+        :type n_components: int
+        """
+        self.pca_components = n_components
+        self.projection = pca.fit_projection(self.encoded_keys, n_components)
+
+    def clear(self) -> None:
+        """
+        Clear the index.
+        """
+        super().clear()
+        self.projection = None
+        self.partitions = None
+
+    def create_index(self, key_value_pairs: List[Tuple[str, Any]], checkpoint_dir: str = None, chunk_size: int = 50000, num_workers: int = 1) -> None:
+        """
+        Create the index.
+
+        :param key_value_pairs: The key-value pairs to create the index from.
+        :type key_value_pairs: List[Tuple[str, Any]]
+        :param checkpoint_dir: The directory to write encoded chunks to.
+        :type checkpoint_dir: str, optional
+        :param chunk_size: The number of keys per chunk.
+        :type chunk_size: int
+        :param num_workers: The number of worker processes encoding chunks.
+        :type num_workers: int
+        """
+        super().create_index(key_value_pairs, checkpoint_dir, chunk_size, num_workers)
+        if self.pca_components is not None:
+            self.fit_pca(self.pca_components)
     
     def load(self, path: str):
         """
@@ -55,6 +156,6 @@ class GTR(KVStore):
         :rtype: GTR
         """
         super().load(path)
-        self._model = sentence_transformers.SentenceTransformer(self.model_path, device="cuda", cache_folder=utils.get_cache_dir())
+        self._load_model()
         return self
         
@@ -0,0 +1,174 @@
+import os
+import numpy as np
+from typing import List, Tuple, Union, Any
+from sklearn.metrics.pairwise import cosine_similarity
+from .kv_store import KVStore
+from .kv_store import TextType
+
+
+class Hierarchical(KVStore):
+    """
+    Hierarchical paragraph-to-proposition index.
+
+    Queries first score the paragraphs, then only the propositions of the top
+    ``num_paragraphs`` paragraphs. The keys of the index are the propositions,
+    stored contiguously per paragraph.
+    """
+    def __init__(self, index_name: str, dense_type: str = "e5", num_paragraphs: int = 20):
+        """
+        Initialize the Hierarchical class.
+
+        :param index_name: The name of the index.
+        :type index_name: str
+        :param dense_type: The dense backend used for encoding, "e5" or "gtr".
+        :type dense_type: str
+        :param num_paragraphs: The number of top paragraphs whose propositions are scored.
+        :type num_paragraphs: int
+        """
+        super().__init__(index_name, "hierarchical")
+        self.dense_type = dense_type
+        self.num_paragraphs = num_paragraphs
+        self.paragraph_keys = []
+        self.encoded_paragraph_keys = []
+        self.paragraph_values = []
+        self.proposition_offsets = None  # the propositions of paragraph i are keys[offsets[i]:offsets[i + 1]]
+        self._dense = self._initialize_dense()
+
+    def _initialize_dense(self, device: str = "cuda") -> KVStore:
+        """
+        Initialize the dense backend used for encoding.
+
+        :param device: The device to load the model on.
+        :type device: str
+        :raises ValueError: If the dense type is not valid.
+        :return: The dense backend.
+        :rtype: KVStore
+        """
+        if self.dense_type == "e5":
+            from .e5 import E5
+
+            return E5(None, device=device)
+        elif self.dense_type == "gtr":
+            from .gtr import GTR
+
+            return GTR(None, device=device)
+        else:
+            raise ValueError("Invalid dense type, must be 'e5' or 'gtr'")
+
+    def _load_model(self, device: str = "cuda") -> None:
+        """
+        Load the dense backend.
+
+        :param device: The device to load the model on.
+        :type device: str
+        """
+        self._dense = self._initialize_dense(device)
+
+    def _encode_batch(self, texts: List[str], type: TextType, show_progress_bar: bool = True) -> List[Any]:
+        """
+        Encode a batch of texts.
+
+        :param texts: The texts to encode.
+        :type texts: List[str]
+        :param type: The type of text.
+        :type type: TextType
+        :param show_progress_bar: Whether to show a progress bar.
+        :type show_progress_bar: bool
+        :return: The encoded texts.
+        :rtype: List[Any]
+        """
+        return self._dense._encode_batch(texts, type, show_progress_bar=show_progress_bar)
+
+    def _get_encoder_config(self) -> dict:
+        """
+        Get the settings that determine how keys are encoded.
+
+        :return: The dense type and the settings of the dense backend.
+        :rtype: dict
+        """
+        return dict(dense_type=self.dense_type, **self._dense._get_encoder_config())
+
+    def _query(self, encoded_query: Any, n: int) -> List[int]:
+        """
+        Query the index.
+
+        :param encoded_query: The encoded query.
+        :type encoded_query: Any
+        :param n: The number of results to return.
+        :type n: int
+        :return: The indices of the matching propositions.
+        :rtype: List[int]
+        """
+        paragraph_scores = cosine_similarity([encoded_query], self.encoded_paragraph_keys)[0]
+        num_paragraphs = min(max(self.num_paragraphs, 1), len(paragraph_scores))
+        top_paragraphs = np.argpartition(paragraph_scores, -num_paragraphs)[-num_paragraphs:]
+
+        offsets = self.proposition_offsets
+        candidates = np.concatenate([np.arange(offsets[p], offsets[p + 1]) for p in top_paragraphs])
+        if len(candidates) == 0:
+            return []
+        cosine_similarities = cosine_similarity([encoded_query], np.asarray(self.encoded_keys)[candidates])[0]
+        top_candidates = cosine_similarities.argsort()[-n:][::-1]
+        return candidates[top_candidates].tolist()
+
+    def clear(self) -> None:
+        """
+        Clear the index.
+        """
+        super().clear()
+        self.paragraph_keys = []
+        self.encoded_paragraph_keys = []
+        self.paragraph_values = []
+        self.proposition_offsets = None
+
+    def create_index(self, key_value_pairs: Union[dict, Tuple[List[str], List[Any]]], checkpoint_dir: str = None, chunk_size: int = 50000, num_workers: int = 1) -> None:
+        """
+        Create the index.
+
+        :param key_value_pairs: Each paragraph mapped to its location and its propositions, as built by
+            ``IndexBuilder.create_kv_pairs`` with "hierarchical" granularity, either a dict or parallel columns.
+        :type key_value_pairs: Union[dict, Tuple[List[str], List[Any]]]
+        :param checkpoint_dir: The directory to write encoded chunks of propositions to, and of paragraphs
+            to its "paragraphs" subdirectory.
+        :type checkpoint_dir: str, optional
+        :param chunk_size: The number of propositions or paragraphs per chunk.
+        :type chunk_size: int
+        :param num_workers: The number of worker processes encoding chunks.
+        :type num_workers: int
+        """
+        if len(self.keys) > 0:
+            raise ValueError("Index is not empty. Please create a new index or clear the existing one.")
+
+        if isinstance(key_value_pairs, dict):
+            key_value_pairs = (key_value_pairs.keys(), key_value_pairs.values())
+        keys, values, offsets = [], [], [0]
+        for paragraph, (location, propositions) in zip(*key_value_pairs):
+            self.paragraph_keys.append(paragraph)
+            self.paragraph_values.append(location)
+            for proposition_idx, proposition in enumerate(propositions):
+                keys.append(proposition)
+                values.append(tuple(location) + (proposition_idx,))
+            offsets.append(len(keys))
+        self.proposition_offsets = np.array(offsets, dtype=np.int64)
+
+        super().create_index((keys, values), checkpoint_dir, chunk_size, num_workers)
+        if checkpoint_dir is None and num_workers <= 1:
+            self.encoded_paragraph_keys = self._encode_batch(self.paragraph_keys, TextType.KEY)
+        else:
+            paragraph_checkpoint_dir = os.path.join(checkpoint_dir, "paragraphs") if checkpoint_dir is not None else None
+            paragraph_chunks = self._iter_encoded_chunks(paragraph_checkpoint_dir, chunk_size, num_workers, self.paragraph_keys)
+            self.encoded_paragraph_keys = self._concatenate_chunks(paragraph_chunks, len(self.paragraph_keys))
+
+    def load(self, path: str):
+        """
+        Load the index from disk.
+
+        :param path: The path to load the index from.
+        :type path: str
+        :return: The index.
+        :rtype: Hierarchical
+        """
+        super().load(path)
+        if self._dense.index_type != self.dense_type:
+            self._dense = self._initialize_dense()
+        return self
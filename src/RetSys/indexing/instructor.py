@@ -12,7 +12,10 @@ class Instructor(KVStore):
         self.model_path = model_path
         self.key_instruction = key_instruction
         self.query_instruction = query_instruction
-        self._model = INSTRUCTOR(model_path, device="cuda", cache_folder=utils.get_cache_dir())
+        self._load_model()
+
+    def _load_model(self, device: str = "cuda") -> None:
+        self._model = INSTRUCTOR(self.model_path, device=device, cache_folder=utils.get_cache_dir())
     
     def _format_text(self, text: str, type: TextType) -> List[str]:
         if type == TextType.KEY:
@@ -25,14 +28,20 @@ class Instructor(KVStore):
     def _encode_batch(self, texts: List[str], type: TextType, show_progress_bar: bool = True) -> List[Any]:
         texts = [self._format_text(text, type) for text in texts]
         return self._model.encode(texts, batch_size=128, normalize_embeddings=True, show_progress_bar=show_progress_bar).astype(np.float16)
+
+    def _get_encoder_config(self) -> dict:
+        return {"model_path": self.model_path, "key_instruction": self.key_instruction}
     
     def _query(self, encoded_query: Any, n: int) -> List[int]:
-        cosine_similarities = cosine_similarity([encoded_query], self.encoded_keys)[0]
+        cosine_similarities = self._get_scores(encoded_query)
         top_indices = cosine_similarities.argsort()[-n:][::-1]
         return top_indices
+
+    def _get_scores(self, encoded_query: Any) -> np.ndarray:
+        return cosine_similarity([encoded_query], self.encoded_keys)[0]
     
     def load(self, path: str):
         super().load(path)
-        self._model = INSTRUCTOR(self.model_path, device="cuda", cache_folder=utils.get_cache_dir())
+        self._load_model()
         return self
         
@@ -1,13 +1,182 @@
 import os
+import json
+import time
 import pickle
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import multiprocessing
 from tqdm import tqdm
 from enum import Enum
-from typing import List, Tuple, Any
+from typing import List, Tuple, Union, Iterator, Any
 
 class TextType(Enum):
     KEY = 1
     QUERY = 2
 
+SNAPSHOT_POINTER = "LATEST"
+SNAPSHOT_DIR_SUFFIX = "snapshots"
+GROUP_BY = ("document", "page")
+AGGREGATES = ("max", "sum")
+
+
+class QueryResults(list):
+    """
+    Results of a query, flagged as partial when a latency budget stopped the search early.
+    """
+    partial = False
+
+
+##### chunked encoding in worker processes #####
+
+_worker_index = None
+
+
+def _init_encode_worker(index_class: type, state: dict, devices: Any, num_threads: int) -> None:
+    global _worker_index
+    import torch
+
+    torch.set_num_threads(num_threads)
+    _worker_index = index_class.__new__(index_class)
+    _worker_index.__dict__.update(state)
+    _worker_index._load_model(devices.get())
+
+
+def _encode_chunk(task: Tuple[int, List[str], str]) -> int:
+    chunk_idx, texts, chunk_path = task
+    _save_chunk(_worker_index._encode_batch(texts, TextType.KEY, show_progress_bar=False), chunk_path)
+    return chunk_idx
+
+
+def _save_chunk(encoded: Any, chunk_path: str) -> None:
+    # write to a temporary file first so an interrupted write is never taken for a finished chunk
+    if isinstance(encoded, np.ndarray):
+        file_path = chunk_path + ".npy"
+        with open(file_path + ".tmp", "wb") as file:
+            np.save(file, encoded)
+    else:
+        file_path = chunk_path + ".pkl"
+        with open(file_path + ".tmp", "wb") as file:
+            pickle.dump(encoded, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(file_path + ".tmp", file_path)
+
+
+def _find_chunk(chunk_path: str) -> str:
+    for file_path in (chunk_path + ".npy", chunk_path + ".pkl"):
+        if os.path.exists(file_path):
+            return file_path
+    return None
+
+
+def _load_chunk(file_path: str) -> Any:
+    if file_path.endswith(".npy"):
+        return np.load(file_path, mmap_mode="r")
+    with open(file_path, "rb") as file:
+        return pickle.load(file)
+
+
+##### atomic saving and versioned snapshots #####
+
+
+def _set_default_permissions(file_path: str) -> None:
+    # mkstemp creates owner-only files, give them the permissions a plain open() would
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(file_path, 0o666 & ~umask)
+
+
+def _atomic_write(file_path: str, data: Any) -> None:
+    """
+    Write to a temporary file in the same directory, then move it over the destination.
+
+    :param file_path: The destination path.
+    :type file_path: str
+    :param data: A string to write as text, anything else is pickled.
+    :type data: Any
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(file_path)}.", suffix=".tmp", dir=os.path.dirname(file_path) or ".")
+    try:
+        with os.fdopen(fd, "w" if isinstance(data, str) else "wb") as file:
+            if isinstance(data, str):
+                file.write(data)
+            else:
+                pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL)
+            file.flush()
+            os.fsync(file.fileno())
+        _set_default_permissions(tmp_path)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _link_snapshot_file(source_path: str, target_path: str) -> None:
+    """
+    Give a snapshot its own name for a file, hard-linked or copied across file systems.
+
+    Rewriting the source with a new file afterwards then leaves the snapshot's file unchanged.
+
+    :param source_path: The path of the existing file.
+    :type source_path: str
+    :param target_path: The path of the file in the snapshot directory.
+    :type target_path: str
+    """
+    tmp_path = target_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(source_path, tmp_path)
+    except OSError:
+        shutil.copyfile(source_path, tmp_path)
+    os.replace(tmp_path, target_path)
+
+
+def _get_snapshot_versions(snapshot_dir: str, index_type: str) -> List[int]:
+    versions = []
+    for file_name in os.listdir(snapshot_dir):
+        version, _, extension = file_name.partition(".")
+        if extension == index_type and version.isdigit():
+            versions.append(int(version))
+    return sorted(versions)
+
+
+def get_snapshot_dir(dir_name: str, index_name: str, index_type: str) -> str:
+    """
+    Get the snapshot directory of an index.
+
+    It is named ``<index_name>.snapshots.<index_type>``, distinct from the file ``save()`` writes,
+    so an index saved in place can switch to snapshots.
+
+    :param dir_name: The directory the index is saved in.
+    :type dir_name: str
+    :param index_name: The name of the index.
+    :type index_name: str
+    :param index_type: The type of index.
+    :type index_type: str
+    :return: The path of the snapshot directory.
+    :rtype: str
+    """
+    return os.path.join(dir_name, f"{index_name}.{SNAPSHOT_DIR_SUFFIX}.{index_type}")
+
+
+def get_latest_snapshot(snapshot_dir: str) -> str:
+    """
+    Get the path of the published snapshot in a snapshot directory.
+
+    :param snapshot_dir: The snapshot directory.
+    :type snapshot_dir: str
+    :return: The path of the snapshot, None if none was published.
+    :rtype: str
+    """
+    pointer_path = os.path.join(snapshot_dir, SNAPSHOT_POINTER)
+    if not os.path.exists(pointer_path):
+        return None
+    with open(pointer_path, "r") as file:
+        return os.path.join(snapshot_dir, file.read().strip())
+
+
 class KVStore:
     """
     Base class for key-value stores.
@@ -27,6 +196,7 @@ class KVStore:
         self.keys = []
         self.encoded_keys = []
         self.values = []
+        self._groups = {}  # group_by -> (row order, group offsets), built on first use
 
     def __len__(self) -> int:
         """
@@ -64,6 +234,17 @@ class KVStore:
         :rtype: List[Any]
         """
         raise NotImplementedError
+
+    def _load_model(self, device: str = "cuda") -> None:
+        """
+        Load the model used for encoding.
+
+        Called after loading from disk and when the index is rebuilt in a worker process.
+
+        :param device: The device to load the model on.
+        :type device: str
+        """
+        pass
     
     def _query(self, encoded_query: Any, n: int) -> List[int]:
         """
@@ -77,6 +258,89 @@ class KVStore:
         :rtype: List[int]
         """
         raise NotImplementedError
+
+    def _get_scores(self, encoded_query: Any) -> np.ndarray:
+        """
+        Score every key.
+
+        :param encoded_query: The encoded query.
+        :type encoded_query: Any
+        :raises NotImplementedError: If the index does not score every key.
+        :return: The score of each key.
+        :rtype: np.ndarray
+        """
+        raise NotImplementedError(f"{type(self).__name__} indices do not support grouped queries")
+
+    def _get_groups(self, group_by: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get the rows of each document or page as contiguous ranges.
+
+        :param group_by: "document" to group the keys by file, "page" to group them by corpus id.
+        :type group_by: str
+        :return: The permutation making each group's rows contiguous (None if they already are),
+            and the offsets of the groups in it.
+        :rtype: Tuple[np.ndarray, np.ndarray]
+        """
+        if group_by not in self._groups:
+            corpusids = [self._get_corpusid(i) for i in range(len(self.keys))]
+            if group_by == "document":
+                corpusids = [corpusid.split("_page_")[0] for corpusid in corpusids]
+            _, group_ids = np.unique(corpusids, return_inverse=True)
+            group_ids = group_ids.reshape(-1)
+
+            order = None
+            changes = np.flatnonzero(group_ids[1:] != group_ids[:-1]) + 1
+            if len(changes) + 1 != group_ids.max(initial=-1) + 1:
+                # some group is split across non-adjacent rows
+                order = np.argsort(group_ids, kind="stable")
+                changes = np.flatnonzero(np.diff(group_ids[order])) + 1
+            self._groups[group_by] = (order, np.concatenate(([0], changes, [len(group_ids)])))
+        return self._groups[group_by]
+
+    def _query_grouped(self, encoded_query: Any, n: int, group_by: str, aggregate: str) -> List[int]:
+        """
+        Query the index for the top documents or pages, returning the best key of each.
+
+        Key scores are reduced per group in one pass over contiguous row ranges.
+
+        :param encoded_query: The encoded query.
+        :type encoded_query: Any
+        :param n: The number of groups to return.
+        :type n: int
+        :param group_by: "document" or "page".
+        :type group_by: str
+        :param aggregate: How the key scores of a group are combined, "max" or "sum".
+        :type aggregate: str
+        :return: The index of the best key of each of the top groups.
+        :rtype: List[int]
+        """
+        if len(self.keys) == 0 or n <= 0:
+            return []
+        scores = self._get_scores(encoded_query)
+        order, offsets = self._get_groups(group_by)
+        if order is not None:
+            scores = scores[order]
+
+        starts = offsets[:-1]
+        if aggregate == "max":
+            group_scores = np.maximum.reduceat(scores, starts)
+        else:
+            group_scores = np.add.reduceat(scores, starts)
+        n = min(n, len(group_scores))
+        top_groups = np.argpartition(-group_scores, n - 1)[:n]
+        top_groups = top_groups[np.argsort(-group_scores[top_groups], kind="stable")]
+
+        best_rows = np.array([starts[g] + np.argmax(scores[starts[g] : offsets[g + 1]]) for g in top_groups], dtype=np.int64)
+        if order is not None:
+            best_rows = order[best_rows]
+        return best_rows.tolist()
+
+    @staticmethod
+    def _check_grouping(group_by: str, aggregate: str) -> None:
+        if group_by is not None and group_by not in GROUP_BY:
+            raise ValueError(f"Invalid group_by, must be one of {GROUP_BY}")
+        if aggregate not in AGGREGATES:
+            raise ValueError(f"Invalid aggregate, must be one of {AGGREGATES}")
     
     def clear(self) -> None:
         """
@@ -85,23 +349,227 @@ class KVStore:
         self.keys = []
         self.encoded_keys = []
         self.values = []
+        self._groups = {}
 
-    def create_index(self, key_value_pairs: List[Tuple[str, Any]]) -> None:
+    def create_index(self, key_value_pairs: Union[dict, Tuple[List[str], List[Any]]], checkpoint_dir: str = None, chunk_size: int = 50000, num_workers: int = 1) -> None:
         """
         Create the index.
 
-        :param key_value_pairs: The key-value pairs to create the index from.
-        :type key_value_pairs: List[Tuple[str, Any]]
+        If a checkpoint directory or several workers are given, the keys are encoded in chunks
+        and every finished chunk is written to disk, so an interrupted build resumes from the
+        completed chunks.
+
+        :param key_value_pairs: The key-value pairs to create the index from, either a dict or parallel key and value columns.
+        :type key_value_pairs: Union[dict, Tuple[List[str], List[Any]]]
+        :param checkpoint_dir: The directory to write encoded chunks to.
+        :type checkpoint_dir: str, optional
+        :param chunk_size: The number of keys per chunk.
+        :type chunk_size: int
+        :param num_workers: The number of worker processes encoding chunks.
+        :type num_workers: int
+        """
+        self._add_key_value_pairs(key_value_pairs)
+        if checkpoint_dir is None and num_workers <= 1:
+            self.encoded_keys = self._encode_batch(self.keys, TextType.KEY)
+        else:
+            self.encoded_keys = self._concatenate_chunks(self._iter_encoded_chunks(checkpoint_dir, chunk_size, num_workers), len(self.keys))
+
+    def _add_key_value_pairs(self, key_value_pairs: Union[dict, Tuple[List[str], List[Any]]]) -> None:
+        """
+        Set the keys and values of an empty index.
+
+        :param key_value_pairs: The key-value pairs, either a dict or parallel key and value columns.
+        :type key_value_pairs: Union[dict, Tuple[List[str], List[Any]]]
+        :raises ValueError: If the index is not empty.
+        :raises ValueError: If the key and value columns have different lengths.
         """
         if len(self.keys) > 0:
             raise ValueError("Index is not empty. Please create a new index or clear the existing one.")
         
-        for key, value in tqdm(key_value_pairs.items(), desc=f"Creating {self.index_name} index"):
-            self.keys.append(key)
-            self.values.append(value)
-        self.encoded_keys = self._encode_batch(self.keys, TextType.KEY)
+        if isinstance(key_value_pairs, dict):
+            for key, value in tqdm(key_value_pairs.items(), desc=f"Creating {self.index_name} index"):
+                self.keys.append(key)
+                self.values.append(value)
+        else:
+            keys, values = key_value_pairs
+            if len(keys) != len(values):
+                raise ValueError("Keys and values must have the same length.")
+            self.keys = list(keys)
+            self.values = list(values)
+
+    def _iter_encoded_chunks(self, checkpoint_dir: str, chunk_size: int, num_workers: int, texts: List[str] = None) -> Iterator[Any]:
+        """
+        Encode the keys chunk by chunk and yield the encoded chunks in order.
+
+        Without a checkpoint directory or extra workers the chunks are encoded in this process
+        as they are consumed, otherwise they are written to disk first (to a temporary directory
+        removed afterwards if none is given) and read back one at a time.
 
-    def query(self, query_text: str, n: int, return_keys: bool = False, return_page_number: bool = False) -> List[Any]:
+        :param checkpoint_dir: The directory to write encoded chunks to.
+        :type checkpoint_dir: str, optional
+        :param chunk_size: The number of keys per chunk.
+        :type chunk_size: int
+        :param num_workers: The number of worker processes encoding chunks.
+        :type num_workers: int
+        :param texts: The texts to encode as keys instead of the keys of the index.
+        :type texts: List[str], optional
+        :return: The encoded chunks.
+        :rtype: Iterator[Any]
+        """
+        if texts is None:
+            texts = self.keys
+        if checkpoint_dir is None and num_workers <= 1:
+            if chunk_size <= 0:
+                raise ValueError("chunk_size must be positive")
+            for start in tqdm(range(0, len(texts), chunk_size), desc=f"Encoding {self.index_name} chunks"):
+                yield self._encode_batch(texts[start : start + chunk_size], TextType.KEY, show_progress_bar=False)
+        elif checkpoint_dir is None:
+            checkpoint_dir = tempfile.mkdtemp(prefix=f"{self.index_name}_")
+            try:
+                for chunk_path in self._write_encoded_chunks(texts, checkpoint_dir, chunk_size, num_workers):
+                    yield _load_chunk(_find_chunk(chunk_path))
+            finally:
+                shutil.rmtree(checkpoint_dir, ignore_errors=True)
+        else:
+            for chunk_path in self._write_encoded_chunks(texts, checkpoint_dir, chunk_size, num_workers):
+                yield _load_chunk(_find_chunk(chunk_path))
+
+    @staticmethod
+    def _concatenate_chunks(chunks: Iterator[Any], num_keys: int) -> List[Any]:
+        """
+        Copy encoded chunks one at a time into a single result.
+
+        :param chunks: The encoded chunks, in order.
+        :type chunks: Iterator[Any]
+        :param num_keys: The total number of encoded keys.
+        :type num_keys: int
+        :return: The encoded keys, an array if the chunks are arrays.
+        :rtype: List[Any]
+        """
+        encoded_keys = None
+        start = 0
+        for chunk in chunks:
+            if isinstance(chunk, np.ndarray):
+                if encoded_keys is None:
+                    encoded_keys = np.empty((num_keys,) + chunk.shape[1:], dtype=chunk.dtype)
+                encoded_keys[start : start + len(chunk)] = chunk
+            else:
+                if encoded_keys is None:
+                    encoded_keys = []
+                encoded_keys.extend(chunk)
+            start += len(chunk)
+            del chunk
+        return encoded_keys if encoded_keys is not None else []
+
+    def _get_encoder_config(self) -> dict:
+        """
+        Get the settings that determine how keys are encoded, e.g. the model and key instruction.
+
+        Recorded in the checkpoint manifest so chunks encoded with another configuration are not reused.
+        Encoding worker processes receive only these settings as attributes, together with the index
+        name and type, so they are named after the attributes ``_load_model`` and ``_encode_batch`` read.
+
+        :return: The encoder settings, JSON-serializable.
+        :rtype: dict
+        """
+        return {}
+
+    def _write_encoded_chunks(self, texts: List[str], checkpoint_dir: str, chunk_size: int, num_workers: int) -> List[str]:
+        """
+        Encode a batch of keys chunk by chunk, skipping chunks already in the checkpoint directory.
+
+        Worker processes are started with the "spawn" method, so scripts using more than one
+        worker must guard their entry point with ``if __name__ == "__main__":``.
+
+        :param texts: The keys to encode.
+        :type texts: List[str]
+        :param checkpoint_dir: The directory to write encoded chunks to.
+        :type checkpoint_dir: str
+        :param chunk_size: The number of keys per chunk.
+        :type chunk_size: int
+        :param num_workers: The number of worker processes encoding chunks.
+        :type num_workers: int
+        :raises ValueError: If the checkpoint directory was created for different keys or a different encoder.
+        :return: The paths of the encoded chunks, in order.
+        :rtype: List[str]
+        """
+        if chunk_size <= 0:
+            raise ValueError("chunk_size must be positive")
+
+        keys_hash = hashlib.sha1()
+        for text in texts:
+            keys_hash.update(text.encode("utf-8") + b"\0")
+        manifest = {
+            "index_type": self.index_type,
+            "encoder": self._get_encoder_config(),
+            "num_keys": len(texts),
+            "chunk_size": chunk_size,
+            "keys_hash": keys_hash.hexdigest(),
+        }
+
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        manifest_path = os.path.join(checkpoint_dir, "manifest.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as file:
+                if json.load(file) != manifest:
+                    raise ValueError(f"Checkpoint directory {checkpoint_dir} was created for different keys or a different encoder. Please use an empty directory.")
+        else:
+            with open(manifest_path, "w") as file:
+                json.dump(manifest, file)
+
+        starts = range(0, len(texts), chunk_size)
+        chunk_paths = [os.path.join(checkpoint_dir, f"chunk_{chunk_idx:06d}") for chunk_idx in range(len(starts))]
+        pending = [chunk_idx for chunk_idx, chunk_path in enumerate(chunk_paths) if _find_chunk(chunk_path) is None]
+        if len(pending) < len(chunk_paths):
+            print(f"Resuming from {len(chunk_paths) - len(pending)} of {len(chunk_paths)} encoded chunks in {checkpoint_dir}")
+
+        tasks = ((chunk_idx, texts[starts[chunk_idx] : starts[chunk_idx] + chunk_size], chunk_paths[chunk_idx]) for chunk_idx in pending)
+        progress_bar = tqdm(total=len(pending), desc=f"Encoding {self.index_name} chunks")
+        if num_workers <= 1:
+            for chunk_idx, chunk_texts, chunk_path in tasks:
+                _save_chunk(self._encode_batch(chunk_texts, TextType.KEY, show_progress_bar=False), chunk_path)
+                progress_bar.update()
+        elif len(pending) > 0:
+            import torch
+
+            if torch.cuda.is_available():
+                devices = [f"cuda:{i % torch.cuda.device_count()}" for i in range(num_workers)]
+                num_threads = 1
+            else:
+                devices = ["cpu"] * num_workers
+                num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+            # only what encoding needs, so the corpus is not copied into every worker
+            state = dict(self._get_encoder_config(), index_name=self.index_name, index_type=self.index_type)
+
+            context = multiprocessing.get_context("spawn")
+            device_queue = context.Queue()
+            for device in devices:
+                device_queue.put(device)
+            with context.Pool(num_workers, initializer=_init_encode_worker, initargs=(type(self), state, device_queue, num_threads)) as pool:
+                for _ in pool.imap_unordered(_encode_chunk, tasks):
+                    progress_bar.update()
+        progress_bar.close()
+        return chunk_paths
+
+    def _query_budgeted(self, encoded_query: Any, n: int, deadline: float) -> Tuple[List[int], bool]:
+        """
+        Query the index, stopping early once the deadline has passed.
+
+        Indices that cannot search incrementally do a full scan.
+
+        :param encoded_query: The encoded query.
+        :type encoded_query: Any
+        :param n: The number of results to return.
+        :type n: int
+        :param deadline: The ``time.perf_counter()`` value by which to return.
+        :type deadline: float
+        :return: The indices of the results, and whether the search stopped early.
+        :rtype: Tuple[List[int], bool]
+        """
+        return self._query(encoded_query, n), False
+
+    def query(self, query_text: str, n: int, return_keys: bool = False, return_page_number: bool = False, budget_ms: float = None,
+              group_by: str = None, aggregate: str = "max") -> List[Any]:
         """
         Query the index.
 
@@ -113,19 +581,107 @@ class KVStore:
         :type return_keys: bool
         :param return_page_number: Whether to return the page number.
         :type return_page_number: bool
+        :param budget_ms: The latency budget in milliseconds. Once it is spent the best results found so far
+            are returned with ``partial`` set on the results.
+        :type budget_ms: float, optional
+        :param group_by: "document" or "page" to return the best key of each of the top n documents or pages.
+        :type group_by: str, optional
+        :param aggregate: How the key scores of a group are combined, "max" or "sum".
+        :type aggregate: str
+        :raises ValueError: If group_by or aggregate is not valid, or group_by is combined with budget_ms.
         :return: The results.
         :rtype: List[Any]
         """
+        self._check_grouping(group_by, aggregate)
+        if group_by is not None:
+            if budget_ms is not None:
+                raise ValueError("group_by does not support budget_ms")
+            encoded_query = self._encode(query_text, TextType.QUERY)
+            indices = self._query_grouped(encoded_query, n, group_by, aggregate)
+            return self._format_results(indices, return_keys, return_page_number)
+
+        if budget_ms is None:
+            encoded_query = self._encode(query_text, TextType.QUERY)
+            indices = self._query(encoded_query, n)
+            return self._format_results(indices, return_keys, return_page_number)
+
+        deadline = time.perf_counter() + budget_ms / 1000
         encoded_query = self._encode(query_text, TextType.QUERY)
-        indices = self._query(encoded_query, n)
-        final_results = [] # list of dictionaries
+        indices, partial = self._query_budgeted(encoded_query, n, deadline)
+        final_results = self._format_results(indices, return_keys, return_page_number)
+        final_results.partial = partial
+        return final_results
+
+    def query_batch(self, query_texts: List[str], n: int, return_keys: bool = False, return_page_number: bool = False,
+                    group_by: str = None, aggregate: str = "max") -> List[List[Any]]:
+        """
+        Query the index with a batch of queries, encoding them together.
+
+        :param query_texts: The query texts.
+        :type query_texts: List[str]
+        :param n: The number of results to return per query.
+        :type n: int
+        :param return_keys: Whether to return the keys.
+        :type return_keys: bool
+        :param return_page_number: Whether to return the page number.
+        :type return_page_number: bool
+        :param group_by: "document" or "page" to return the best key of each of the top n documents or pages.
+        :type group_by: str, optional
+        :param aggregate: How the key scores of a group are combined, "max" or "sum".
+        :type aggregate: str
+        :return: The results of each query.
+        :rtype: List[List[Any]]
+        """
+        self._check_grouping(group_by, aggregate)
+        encoded_queries = self._encode_batch(query_texts, TextType.QUERY, show_progress_bar=False)
+        if group_by is not None:
+            return [
+                self._format_results(self._query_grouped(encoded_query, n, group_by, aggregate), return_keys, return_page_number)
+                for encoded_query in encoded_queries
+            ]
+        return [
+            self._format_results(self._query(encoded_query, n), return_keys, return_page_number)
+            for encoded_query in encoded_queries
+        ]
+
+    def _get_corpusid(self, i: int) -> str:
+        """
+        Get the corpus id of a key.
+
+        Deduplicated indices store a list of locations per key, the first being the representative's.
+
+        :param i: The index of the key.
+        :type i: int
+        :return: The corpus id.
+        :rtype: str
+        """
+        location = self.values[i]
+        if isinstance(location, list):
+            location = location[0]
+        return location[0]
+
+    def _format_results(self, indices: List[int], return_keys: bool, return_page_number: bool) -> List[Any]:
+        """
+        Format the results of a query.
+
+        :param indices: The indices of the results.
+        :type indices: List[int]
+        :param return_keys: Whether to return the keys.
+        :type return_keys: bool
+        :param return_page_number: Whether to return the page number.
+        :type return_page_number: bool
+        :return: The results.
+        :rtype: List[Any]
+        """
+        final_results = QueryResults() # list of dictionaries
         
         if return_page_number and return_keys:
             
             for i in indices:
                 answer_format = {"Text": "", "Page Number": "", "Location": ""}
-                if "_page_" in self.values[i][0]:
-                    page_number = self.values[i][0].split("_page_")[1]
+                corpusid = self._get_corpusid(i)
+                if "_page_" in corpusid:
+                    page_number = corpusid.split("_page_")[1]
                 else:
                     page_number = "UNKNOWN"
                 answer_format["Text"] = self.keys[i]
@@ -135,8 +691,9 @@ class KVStore:
         elif return_page_number:
             for i in indices:
                 answer_format = {"Page Number": "", "Location": ""}
-                if "_page_" in self.values[i][0]:
-                    page_number = self.values[i][0].split("_page_")[1]
+                corpusid = self._get_corpusid(i)
+                if "_page_" in corpusid:
+                    page_number = corpusid.split("_page_")[1]
                 else:
                     page_number = "UNKNOWN"
                 answer_format["Page Number"] = page_number
@@ -159,19 +716,75 @@ class KVStore:
         """
         Save the index to disk.
 
+        The index is written to a temporary file that then replaces the old one, so a
+        crash mid-write never leaves a corrupted index behind.
+
         :param dir_name: The directory to save the index.
         :type dir_name: str
         """
+        print(f"Saving index to {os.path.join(dir_name, f'{self.index_name}.{self.index_type}')}")
+        os.makedirs(dir_name, exist_ok=True)
+        _atomic_write(os.path.join(dir_name, f"{self.index_name}.{self.index_type}"), self._get_save_dict())
+
+    def save_snapshot(self, dir_name: str, keep_last: int = 3) -> str:
+        """
+        Save the index as a new versioned snapshot and publish it.
+
+        Snapshots live in the ``<index_name>.snapshots.<index_type>`` directory as ``<version>.<index_type>``
+        files. The new snapshot is written in full before the ``LATEST`` pointer is atomically
+        switched to it, so readers only ever see complete snapshots.
+
+        :param dir_name: The directory to save the index.
+        :type dir_name: str
+        :param keep_last: The number of snapshots to keep, None to keep all of them.
+        :type keep_last: int, optional
+        :return: The path of the published snapshot.
+        :rtype: str
+        """
+        snapshot_dir = get_snapshot_dir(dir_name, self.index_name, self.index_type)
+        os.makedirs(snapshot_dir, exist_ok=True)
+        versions = _get_snapshot_versions(snapshot_dir, self.index_type)
+        version = versions[-1] + 1 if len(versions) > 0 else 1
+        snapshot_name = f"{version:06d}.{self.index_type}"
+
+        print(f"Saving index snapshot to {os.path.join(snapshot_dir, snapshot_name)}")
+        self._save_snapshot_files(snapshot_dir, version)
+        _atomic_write(os.path.join(snapshot_dir, snapshot_name), self._get_save_dict())
+        _atomic_write(os.path.join(snapshot_dir, SNAPSHOT_POINTER), snapshot_name)
+
+        if keep_last is not None:
+            old_prefixes = tuple(f"{old_version:06d}." for old_version in versions[: max(0, len(versions) + 1 - keep_last)])
+            for file_name in os.listdir(snapshot_dir):
+                if len(old_prefixes) > 0 and file_name.startswith(old_prefixes):
+                    os.remove(os.path.join(snapshot_dir, file_name))
+        return os.path.join(snapshot_dir, snapshot_name)
+
+    def _save_snapshot_files(self, snapshot_dir: str, version: int) -> None:
+        """
+        Place the files the index reads besides its pickle next to a new snapshot.
+
+        Called before the snapshot is written. Files named ``<version>.<extension>`` are pruned
+        together with their snapshot.
+
+        :param snapshot_dir: The snapshot directory.
+        :type snapshot_dir: str
+        :param version: The version of the new snapshot.
+        :type version: int
+        """
+        pass
+
+    def _get_save_dict(self) -> dict:
+        """
+        Get the attributes to save, i.e. the public ones.
+
+        :return: The attributes to save.
+        :rtype: dict
+        """
         save_dict = {}
         for key, value in self.__dict__.items():
             if key[0] != "_":
                 save_dict[key] = value
-
-        print(f"Saving index to {os.path.join(dir_name, f'{self.index_name}.{self.index_type}')}")
-        os.makedirs(dir_name, exist_ok=True)
-        with open(os.path.join(dir_name, f"{self.index_name}.{self.index_type}"), 'wb') as file:
-            pickle.dump(save_dict, file, protocol=pickle.HIGHEST_PROTOCOL)
-        
+        return save_dict
 
     def load(self, file_path: str) -> None:
         """
@@ -188,4 +801,5 @@ class KVStore:
             pickle_data = pickle.load(file)
         
         for key, value in pickle_data.items():
-            setattr(self, key, value)
\ No newline at end of file
+            setattr(self, key, value)
+        self._groups = {}
\ No newline at end of file
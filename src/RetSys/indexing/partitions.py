@@ -0,0 +1,76 @@
+import time
+import numpy as np
+from typing import List, Tuple, Any
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.metrics.pairwise import cosine_similarity
+
+##### latency-budgeted search over k-means partitions #####
+
+
+def fit_partitions(encoded_keys: Any, num_partitions: int = None) -> dict:
+    """
+    Cluster the key embeddings into partitions with spherical k-means.
+
+    :param encoded_keys: The key embeddings.
+    :type encoded_keys: Any
+    :param num_partitions: The number of partitions, defaults to the square root of the number of keys.
+    :type num_partitions: int, optional
+    :return: The unit-norm centroids, the key indices sorted by partition and the offset of each partition in them.
+    :rtype: dict
+    """
+    encoded_keys = np.asarray(encoded_keys, dtype=np.float32)
+    if num_partitions is None:
+        num_partitions = max(1, int(np.sqrt(len(encoded_keys))))
+    norms = np.linalg.norm(encoded_keys, axis=1, keepdims=True)
+    normalized_keys = np.divide(encoded_keys, norms, out=np.zeros_like(encoded_keys), where=norms > 0)
+
+    kmeans = MiniBatchKMeans(n_clusters=num_partitions, batch_size=4096, n_init=3, random_state=0).fit(normalized_keys)
+    centroids = kmeans.cluster_centers_.astype(np.float32)
+    centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+    order = np.argsort(kmeans.labels_, kind="stable")
+    offsets = np.searchsorted(kmeans.labels_[order], np.arange(num_partitions + 1))
+    return {"centroids": centroids, "order": order, "offsets": offsets}
+
+
+def budgeted_query(encoded_query: Any, encoded_keys: Any, partitions: dict, n: int, deadline: float) -> Tuple[List[int], bool]:
+    """
+    Scan partitions by decreasing centroid similarity until all are scanned or the deadline passes.
+
+    The partition closest to the query is always scanned.
+
+    :param encoded_query: The query embedding.
+    :type encoded_query: Any
+    :param encoded_keys: The key embeddings.
+    :type encoded_keys: Any
+    :param partitions: The partitions returned by ``fit_partitions``.
+    :type partitions: dict
+    :param n: The number of results to return.
+    :type n: int
+    :param deadline: The ``time.perf_counter()`` value by which to return.
+    :type deadline: float
+    :return: The indices of the results, and whether some partitions were skipped.
+    :rtype: Tuple[List[int], bool]
+    """
+    encoded_keys = np.asarray(encoded_keys)
+    order, offsets = partitions["order"], partitions["offsets"]
+    partition_order = np.argsort(-(partitions["centroids"] @ np.asarray(encoded_query, dtype=np.float32)))
+
+    best_indices = np.empty(0, dtype=order.dtype)
+    best_scores = np.empty(0, dtype=np.float64)
+    partial = False
+    for rank, partition in enumerate(partition_order):
+        if rank > 0 and time.perf_counter() >= deadline:
+            partial = True
+            break
+        members = order[offsets[partition] : offsets[partition + 1]]
+        if len(members) == 0:
+            continue
+        scores = cosine_similarity([encoded_query], encoded_keys[members])[0]
+        best_indices = np.concatenate([best_indices, members])
+        best_scores = np.concatenate([best_scores, scores])
+        if len(best_scores) > n:
+            top = np.argpartition(best_scores, -n)[-n:]
+            best_indices, best_scores = best_indices[top], best_scores[top]
+
+    top = np.argsort(best_scores)[::-1]
+    return best_indices[top].tolist(), partial
@@ -0,0 +1,82 @@
+import numpy as np
+from typing import List, Any
+from sklearn.decomposition import PCA
+from sklearn.metrics.pairwise import cosine_similarity
+
+PCA_SAMPLE_SIZE = 100000  # keys the projection is fitted on
+PROJECTION_CHUNK_SIZE = 65536  # keys converted to float32 at a time when projecting
+
+##### coarse-to-fine search over PCA-reduced embeddings #####
+
+
+def fit_projection(encoded_keys: Any, n_components: int, sample_size: int = PCA_SAMPLE_SIZE) -> dict:
+    """
+    Fit a PCA projection on a random sample of the key embeddings and project the keys.
+
+    The projection stores the reduced keys together with the inverse norms of the
+    full keys, so the coarse score approximates the cosine similarity of the full
+    vectors. Keys are projected in chunks, so no full-precision copy of the keys is made.
+
+    :param encoded_keys: The full key embeddings.
+    :type encoded_keys: Any
+    :param n_components: The number of dimensions to keep.
+    :type n_components: int
+    :param sample_size: The number of keys to fit the projection on.
+    :type sample_size: int
+    :return: The projection.
+    :rtype: dict
+    """
+    encoded_keys = np.asarray(encoded_keys)
+    num_keys = len(encoded_keys)
+    if num_keys > sample_size:
+        sample = np.sort(np.random.default_rng(0).choice(num_keys, size=sample_size, replace=False))
+        fit_keys = np.asarray(encoded_keys[sample], dtype=np.float32)
+    else:
+        fit_keys = np.asarray(encoded_keys, dtype=np.float32)
+    pca = PCA(n_components=n_components, svd_solver="randomized", random_state=0).fit(fit_keys)
+    del fit_keys
+    components = pca.components_.astype(np.float32)
+    mean = pca.mean_.astype(np.float32)
+
+    # the coarse scan stays in float32, numpy has no fast float16 matrix-vector product
+    reduced_keys = np.empty((num_keys, n_components), dtype=np.float32)
+    inverse_norms = np.zeros(num_keys, dtype=np.float32)
+    for start in range(0, num_keys, PROJECTION_CHUNK_SIZE):
+        chunk = np.asarray(encoded_keys[start : start + PROJECTION_CHUNK_SIZE], dtype=np.float32)
+        reduced_keys[start : start + len(chunk)] = (chunk - mean) @ components.T
+        norms = np.linalg.norm(chunk, axis=1)
+        np.divide(1.0, norms, out=inverse_norms[start : start + len(chunk)], where=norms > 0)
+    return {
+        "components": components,
+        "mean": mean,
+        "reduced_keys": reduced_keys,
+        "inverse_norms": inverse_norms,
+    }
+
+
+def coarse_to_fine_query(encoded_query: Any, encoded_keys: Any, projection: dict, n: int, rescore_size: int) -> List[int]:
+    """
+    Scan the reduced keys, then rescore the best candidates with the full keys.
+
+    :param encoded_query: The full query embedding.
+    :type encoded_query: Any
+    :param encoded_keys: The full key embeddings.
+    :type encoded_keys: Any
+    :param projection: The projection returned by ``fit_projection``.
+    :type projection: dict
+    :param n: The number of results to return.
+    :type n: int
+    :param rescore_size: The number of candidates to rescore with the full keys.
+    :type rescore_size: int
+    :return: The indices of the results.
+    :rtype: List[int]
+    """
+    query = np.asarray(encoded_query, dtype=np.float32)
+    reduced_query = projection["components"] @ query
+    coarse_scores = (projection["reduced_keys"] @ reduced_query + query @ projection["mean"]) * projection["inverse_norms"]
+
+    rescore_size = min(max(rescore_size, n), len(coarse_scores))
+    candidates = np.argpartition(coarse_scores, -rescore_size)[-rescore_size:]
+    cosine_similarities = cosine_similarity([encoded_query], np.asarray(encoded_keys)[candidates])[0]
+    top_candidates = cosine_similarities.argsort()[-n:][::-1]
+    return candidates[top_candidates].tolist()
@@ -1,7 +1,10 @@
 from typing import List
 from .build_datasets import DatasetConverter
 from .build_index import IndexBuilder
+from .kv_store import get_latest_snapshot
+from .kv_store import get_snapshot_dir
 import datasets
+import threading
 import os
 
 # Two workflows:
@@ -10,6 +13,8 @@ import os
 #    ret.load_data(...) # Converts data and builds index
 # 2. Load existing index:
 #    ret = Retriever.load_from_path(index_save_dir)
+# 3. Serve the latest published snapshot, swapping in new ones as they are published:
+#    ret = Retriever.load_from_path(snapshot_dir, watch=True)
 
 class Retriever:
     def __init__(self, index_type: str, index_name: str, index_save_dir: str):
@@ -27,15 +32,23 @@ class Retriever:
         self.index_name = index_name 
         self.save_dir = index_save_dir
         self.index = None
+        self.snapshot_path = None  # path of the loaded snapshot when serving a snapshot directory
+        self._snapshot_dir = None
+        self._stop_watching = None
 
     @classmethod
-    def load_from_path(cls, index_path: str):
+    def load_from_path(cls, index_path: str, watch: bool = False, poll_interval: float = 30.0):
         """
         Load an existing index from disk.
 
-        :param index_path: The path to the index.
+        :param index_path: The path to the index, or to a snapshot directory written by ``save_snapshot``.
         :type index_path: str
+        :param watch: Whether to watch the snapshot directory and hot reload newly published snapshots.
+        :type watch: bool
+        :param poll_interval: The number of seconds between checks for a new snapshot.
+        :type poll_interval: float
         """
+        index_path = index_path.rstrip(os.sep)
         index_dir = os.path.dirname(index_path)
         index_name = os.path.basename(index_path)
         index_type = index_name.split(".")[-1]
@@ -44,12 +57,73 @@ class Retriever:
 
         # Load index details from save_dir
 
-        index_builder = IndexBuilder(index_type=index_type, index_name=index_name, save_dir=index_dir)
-        retriever.index = index_builder.load_index(index_path)
-        print(f"Loaded index {index_name} from {index_path}")
+        if os.path.isdir(index_path):
+            retriever._snapshot_dir = index_path
+            retriever.snapshot_path = get_latest_snapshot(index_path)
+            retriever.index = IndexBuilder.load_index(retriever.snapshot_path or index_path)
+        else:
+            retriever.index = IndexBuilder.load_index(index_path)
+        print(f"Loaded index {index_name} from {retriever.snapshot_path or index_path}")
+        if watch:
+            retriever.watch(poll_interval)
         return retriever
+
+    def reload(self) -> bool:
+        """
+        Load the latest published snapshot if it is newer than the one being served, then swap it in.
+
+        The new index is fully loaded before the swap, and queries already running keep
+        using the index they started with.
+
+        :raises ValueError: If the index was not loaded from a snapshot directory.
+        :return: Whether a new snapshot was swapped in.
+        :rtype: bool
+        """
+        if self._snapshot_dir is None:
+            raise ValueError("Reloading requires an index loaded from a snapshot directory")
+        snapshot_path = get_latest_snapshot(self._snapshot_dir)
+        if snapshot_path is None or snapshot_path == self.snapshot_path:
+            return False
+        index = IndexBuilder.load_index(snapshot_path)
+        self.index = index
+        self.snapshot_path = snapshot_path
+        print(f"Swapped in index snapshot {snapshot_path}")
+        return True
+
+    def watch(self, poll_interval: float = 30.0) -> None:
+        """
+        Hot reload newly published snapshots in a background thread.
+
+        :param poll_interval: The number of seconds between checks for a new snapshot.
+        :type poll_interval: float
+        :raises ValueError: If the index was not loaded from a snapshot directory.
+        """
+        if self._snapshot_dir is None:
+            raise ValueError("Watching requires an index loaded from a snapshot directory")
+        if self._stop_watching is not None:
+            return
+        self._stop_watching = threading.Event()
+        threading.Thread(target=self._watch_loop, args=(self._stop_watching, poll_interval), daemon=True).start()
+
+    def stop_watching(self) -> None:
+        """
+        Stop hot reloading new snapshots.
+        """
+        if self._stop_watching is not None:
+            self._stop_watching.set()
+            self._stop_watching = None
+
+    def _watch_loop(self, stop_event: threading.Event, poll_interval: float) -> None:
+        while not stop_event.wait(poll_interval):
+            try:
+                self.reload()
+            except Exception as e:
+                # keep serving the current index, the next poll retries
+                print(f"Failed to reload index from {self._snapshot_dir}: {e}")
     def insert_data_and_save_index(self, dir_path: str, dataset_name: str, private: bool = False,
-                 save_locally: bool = False, save_on_hf_hub: bool = False, dataset_dir: str = ".", granularity: str = "paragraphs"):
+                 save_locally: bool = False, save_on_hf_hub: bool = False, dataset_dir: str = ".", granularity: str = "paragraphs",
+                 checkpoint_dir: str = None, num_workers: int = 1, deduplicate: bool = False,
+                 num_proc: int = None, snapshot: bool = False, memory_budget_mb: float = None):
         """
         Convert data and build new index.
 
@@ -67,6 +141,20 @@ class Retriever:
         :type dataset_dir: str
         :param granularity: The granularity of the index.
         :type granularity: str
+        :param checkpoint_dir: The directory to checkpoint encoded chunks to, so an interrupted build can resume.
+        :type checkpoint_dir: str
+        :param num_workers: The number of worker processes encoding the keys.
+        :type num_workers: int
+        :param deduplicate: Whether to index one representative per cluster of near-duplicate paragraphs.
+        :type deduplicate: bool
+        :param num_proc: The number of processes used to split the corpus into paragraphs.
+        :type num_proc: int
+        :param snapshot: Whether to save the index as a new versioned snapshot instead of overwriting it.
+        :type snapshot: bool
+        :param memory_budget_mb: For BM25 indices, build the postings out of memory within this budget in megabytes,
+            writing them next to the index as ``<index_name>.<index_type>.postings``, or next to the snapshot
+            as ``<version>.postings``.
+        :type memory_budget_mb: float
         """
         # Convert raw data to dataset
         dataset_converter = DatasetConverter()
@@ -79,13 +167,28 @@ class Retriever:
             corpus_data = datasets.load_dataset(dataset_name, split="full")
 
         # Build and save the index
-        index_builder = IndexBuilder(index_type=self.index_type, index_name=self.index_name, save_dir=self.save_dir, granularity=granularity)
-        kv_pairs = index_builder.create_kv_pairs(corpus_data)
-        index_builder.index.create_index(kv_pairs)
-        index_builder.index.save(self.save_dir)
+        index_builder = IndexBuilder(index_type=self.index_type, index_name=self.index_name, save_dir=self.save_dir, granularity=granularity, deduplicate=deduplicate)
+        kv_columns = index_builder.create_kv_columns(corpus_data, num_proc=num_proc)
+        if memory_budget_mb is None:
+            index_builder.index.create_index(kv_columns, checkpoint_dir=checkpoint_dir, num_workers=num_workers)
+        elif self.index_type in ("bm25", "twostage"):
+            if snapshot:
+                # built in the snapshot directory, then moved to the new snapshot's versioned name
+                postings_path = os.path.join(get_snapshot_dir(self.save_dir, self.index_name, self.index_type), ".building.postings")
+            else:
+                postings_path = os.path.join(self.save_dir, f"{self.index_name}.{self.index_type}.postings")
+            index_builder.index.create_index(kv_columns, checkpoint_dir=checkpoint_dir, num_workers=num_workers,
+                                             postings_path=postings_path, memory_budget_mb=memory_budget_mb)
+        else:
+            raise ValueError("memory_budget_mb is only supported for 'bm25' and 'twostage' indices")
+        if snapshot:
+            index_builder.index.save_snapshot(self.save_dir)
+        else:
+            index_builder.index.save(self.save_dir)
         self.index = index_builder.index
 
-    def query(self, query: str, top_k: int = 10, return_keys: bool = False, return_page_number: bool = False):
+    def query(self, query: str, top_k: int = 10, return_keys: bool = False, return_page_number: bool = False, budget_ms: float = None,
+              group_by: str = None, aggregate: str = "max"):
         """
         Query the index.
 
@@ -97,8 +200,42 @@ class Retriever:
         :type return_keys: bool
         :param return_page_number: Whether to return the page number.
         :type return_page_number: bool
+        :param budget_ms: The latency budget in milliseconds. When it runs out the best results found so far
+            are returned and ``partial`` is set on the returned list.
+        :type budget_ms: float
+        :param group_by: "document" or "page" to return the best passage of each of the top_k documents or pages.
+        :type group_by: str
+        :param aggregate: How the passage scores of a document or page are combined, "max" or "sum".
+        :type aggregate: str
+        """
+        index = self.index  # read once so a hot reload cannot swap the index mid-query
+        if index is None:
+            raise ValueError("No index loaded. Either load_data() or load_from_path() must be called first")
+        
+        return index.query(query, top_k, return_keys=return_keys, return_page_number=return_page_number, budget_ms=budget_ms,
+                           group_by=group_by, aggregate=aggregate)
+
+    def query_batch(self, queries: List[str], top_k: int = 10, return_keys: bool = False, return_page_number: bool = False,
+                    group_by: str = None, aggregate: str = "max"):
+        """
+        Query the index with a batch of queries.
+
+        :param queries: The queries to search for.
+        :type queries: List[str]
+        :param top_k: The number of results to return per query.
+        :type top_k: int
+        :param return_keys: Whether to return the keys i.e. the text of the document.
+        :type return_keys: bool
+        :param return_page_number: Whether to return the page number.
+        :type return_page_number: bool
+        :param group_by: "document" or "page" to return the best passage of each of the top_k documents or pages.
+        :type group_by: str
+        :param aggregate: How the passage scores of a document or page are combined, "max" or "sum".
+        :type aggregate: str
         """
-        if self.index is None:
+        index = self.index
+        if index is None:
             raise ValueError("No index loaded. Either load_data() or load_from_path() must be called first")
         
-        return self.index.query(query, top_k, return_keys=return_keys, return_page_number=return_page_number)
\ No newline at end of file
+        return index.query_batch(queries, top_k, return_keys=return_keys, return_page_number=return_page_number,
+                                 group_by=group_by, aggregate=aggregate)
\ No newline at end of file
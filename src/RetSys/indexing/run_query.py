@@ -1,51 +1,154 @@
 import os
+import sys
+import json
+import time
 import argparse
-import datasets
-from tqdm import tqdm
-from RetSys.indexing import utils
-from indexing.kv_store import KVStore
-
-
-def load_index(index_path: str) -> KVStore:
-    index_type = os.path.basename(index_path).split(".")[-1]
-    if index_type == "bm25":
-        from indexing.bm25 import BM25
-
-        index = BM25(None).load(index_path)
-    elif index_type == "instructor":
-        from indexing.instructor import Instructor
-
-        index = Instructor(None, None, None).load(index_path)
-    elif index_type == "e5":
-        from indexing.e5 import E5
-
-        index = E5(None).load(index_path)
-    elif index_type == "gtr":
-        from indexing.gtr import GTR
-
-        index = GTR(None).load(index_path)
-    elif index_type == "grit":
-        from indexing.grit import GRIT
-
-        index = GRIT(None, None).load(index_path)
-    else:
-        raise ValueError("Invalid index type")
-    return index
-
-
-parser = argparse.ArgumentParser()
-parser.add_argument("--index_name", type=str, required=True)
-parser.add_argument(
-    "--index_root_dir", type=str, required=False, default="retrieval_indices"
-)
-parser.add_argument("--top_k", type=int, required=False, default=200)
-args = parser.parse_args()
-
-index = load_index(os.path.join(args.index_root_dir, args.index_name))
-
-while True:
-    query = input("Enter query: ")
-    if query == "exit":
-        break
-    top_k = index.query(query, args.top_k, return_keys=True)
-    print(top_k)
+import contextlib
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Iterator, Tuple, Any
+from .build_index import IndexBuilder
+
+
+def read_batches(file: Any, batch_size: int, query_field: str) -> Iterator[List[dict]]:
+    """
+    Read JSONL query records from a file in batches.
+
+    :param file: The file to read from.
+    :type file: Any
+    :param batch_size: The number of records per batch.
+    :type batch_size: int
+    :param query_field: The field holding the query text.
+    :type query_field: str
+    :raises ValueError: If a record has no query field.
+    :return: The batches of records.
+    :rtype: Iterator[List[dict]]
+    """
+    batch = []
+    for line_number, line in enumerate(file, start=1):
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if query_field not in record:
+            raise ValueError(f"Line {line_number} has no '{query_field}' field")
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def run_batch(index: Any, batch: List[dict], args: argparse.Namespace) -> Tuple[List[dict], float]:
+    """
+    Query the index with a batch of records.
+
+    :param index: The index to query.
+    :type index: KVStore
+    :param batch: The query records.
+    :type batch: List[dict]
+    :param args: The command line arguments.
+    :type args: argparse.Namespace
+    :return: The records with their results, and the latency of the batch in seconds.
+    :rtype: Tuple[List[dict], float]
+    """
+    start = time.perf_counter()
+    results = index.query_batch(
+        [record[args.query_field] for record in batch],
+        args.top_k,
+        return_keys=args.return_keys,
+        return_page_number=args.return_page_number,
+        group_by=args.group_by,
+        aggregate=args.aggregate,
+    )
+    latency = time.perf_counter() - start
+    return [dict(record, results=result) for record, result in zip(batch, results)], latency
+
+
+def write_results(batch_output: Tuple[List[dict], float], output_file: Any, latencies: List[float]) -> int:
+    """
+    Write the results of a batch as JSONL and record the latency of the batch.
+
+    :param batch_output: The records with their results, and the latency of the batch.
+    :type batch_output: Tuple[List[dict], float]
+    :param output_file: The file to write to.
+    :type output_file: Any
+    :param latencies: The batch latencies recorded so far, in seconds.
+    :type latencies: List[float]
+    :return: The number of queries in the batch.
+    :rtype: int
+    """
+    records, latency = batch_output
+    for record in records:
+        output_file.write(json.dumps(record) + "\n")
+    latencies.append(latency)
+    output_file.flush()
+    return len(records)
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Query an index with JSONL queries and write JSONL results.")
+    parser.add_argument("--index_name", type=str, required=True)
+    parser.add_argument(
+        "--index_root_dir", type=str, required=False, default="retrieval_indices"
+    )
+    parser.add_argument("--top_k", type=int, required=False, default=200)
+    parser.add_argument("--input", type=str, required=False, default="-", help="JSONL file of queries, '-' for stdin")
+    parser.add_argument("--output", type=str, required=False, default="-", help="JSONL file of results, '-' for stdout")
+    parser.add_argument("--query_field", type=str, required=False, default="query")
+    parser.add_argument("--batch_size", type=int, required=False, default=64)
+    parser.add_argument("--num_workers", type=int, required=False, default=1)
+    parser.add_argument("--return_keys", action="store_true")
+    parser.add_argument("--return_page_number", action="store_true")
+    parser.add_argument("--group_by", type=str, required=False, default=None, choices=["document", "page"], help="Return the best passage of each of the top documents or pages")
+    parser.add_argument("--aggregate", type=str, required=False, default="max", choices=["max", "sum"])
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] = None) -> None:
+    args = parse_args(argv)
+    index_path = os.path.join(args.index_root_dir, args.index_name)
+
+    # keep stdout clean for the results
+    with contextlib.redirect_stdout(sys.stderr):
+        index = IndexBuilder.load_index(index_path)
+
+    input_file = sys.stdin if args.input == "-" else open(args.input, "r")
+    output_file = sys.stdout if args.output == "-" else open(args.output, "w")
+    latencies, num_queries = [], 0
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=args.num_workers) as executor:
+            # bound the batches in flight so the input is streamed rather than read up front
+            pending = deque()
+            for batch in read_batches(input_file, args.batch_size, args.query_field):
+                pending.append(executor.submit(run_batch, index, batch, args))
+                if len(pending) >= 2 * args.num_workers:
+                    num_queries += write_results(pending.popleft().result(), output_file, latencies)
+            while pending:
+                num_queries += write_results(pending.popleft().result(), output_file, latencies)
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+        if output_file is not sys.stdout:
+            output_file.close()
+    elapsed = time.perf_counter() - start
+
+    if num_queries == 0:
+        print("No queries processed", file=sys.stderr)
+        return
+    # queries of a batch are answered together, so latencies are per batch rather than per query
+    latencies_ms = np.array(latencies) * 1000
+    print(
+        f"Processed {num_queries} queries in {elapsed:.2f}s ({num_queries / elapsed:.1f} queries/s), "
+        f"{len(latencies)} batches of {num_queries / len(latencies):.1f} queries on average. "
+        f"Batch latency p50: {np.percentile(latencies_ms, 50):.1f}ms, "
+        f"p95: {np.percentile(latencies_ms, 95):.1f}ms, "
+        f"p99: {np.percentile(latencies_ms, 99):.1f}ms",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
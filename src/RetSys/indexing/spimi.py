@@ -0,0 +1,263 @@
+import os
+import math
+import mmap
+import zlib
+import heapq
+import pickle
+import shutil
+import tempfile
+import itertools
+import threading
+import numpy as np
+from array import array
+from collections import OrderedDict
+from operator import itemgetter
+from tqdm import tqdm
+from typing import List, Iterable, Iterator, Tuple
+from .bm25 import Postings
+from .bm25 import get_term_postings
+from .kv_store import _set_default_permissions
+
+TERM_OVERHEAD_BYTES = 256  # rough size of a dict entry and two empty arrays per term in a run
+
+##### external-memory (SPIMI) BM25 index construction #####
+
+
+def _sort_run(run: dict, run_idx: int) -> Iterator[Tuple[str, Tuple[int, int], array, array]]:
+    # (run index, insertion position) orders the terms by their first occurrence in the corpus
+    order = {term: position for position, term in enumerate(run)}
+    for term in sorted(run):
+        yield (term, (run_idx, order[term])) + run[term]
+
+
+def _spill_run(run: dict, run_dir: str, run_idx: int) -> str:
+    run_path = os.path.join(run_dir, f"run_{run_idx:06d}.pkl")
+    with open(run_path, "wb") as file:
+        for entry in _sort_run(run, run_idx):
+            pickle.dump(entry, file, protocol=pickle.HIGHEST_PROTOCOL)
+    return run_path
+
+
+def _read_run(run_path: str) -> Iterator[Tuple[str, Tuple[int, int], array, array]]:
+    with open(run_path, "rb") as file:
+        while True:
+            try:
+                yield pickle.load(file)
+            except EOFError:
+                return
+
+
+def build_postings(
+    documents: Iterable[List[str]], postings_path: str, memory_budget_mb: float = 1024, k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25
+) -> "DiskPostings":
+    """
+    Build a compressed on-disk BM25 inverted index from a stream of tokenized documents.
+
+    Postings are accumulated in memory until they exceed the budget, then spilled to disk as a
+    run sorted by term. The runs cover increasing document ranges, so a k-way merge by term
+    yields every postings list in document order. Scores follow ``BM25Okapi``.
+
+    :param documents: The tokenized documents, consumed once.
+    :type documents: Iterable[List[str]]
+    :param postings_path: The path of the postings file to write.
+    :type postings_path: str
+    :param memory_budget_mb: The memory for postings accumulated before spilling a run, in megabytes.
+    :type memory_budget_mb: float
+    :param k1: The BM25 term frequency saturation.
+    :type k1: float
+    :param b: The BM25 length normalization.
+    :type b: float
+    :param epsilon: The floor of the idf, as a fraction of the average idf.
+    :type epsilon: float
+    :raises ValueError: If the memory budget is not positive.
+    :raises ValueError: If there are no documents.
+    :return: The postings.
+    :rtype: DiskPostings
+    """
+    if memory_budget_mb <= 0:
+        raise ValueError("memory_budget_mb must be positive")
+    budget_bytes = memory_budget_mb * 1024 * 1024
+    postings_dir = os.path.dirname(os.path.abspath(postings_path))
+    os.makedirs(postings_dir, exist_ok=True)
+    run_dir = tempfile.mkdtemp(prefix=".spimi_", dir=postings_dir)
+    try:
+        doc_len = array("I")
+        run, run_bytes, run_paths = {}, 0, []
+        for document in tqdm(documents, desc="Inverting documents"):
+            doc_id = len(doc_len)
+            doc_len.append(len(document))
+            frequencies = {}
+            for term in document:
+                frequencies[term] = frequencies.get(term, 0) + 1
+            for term, freq in frequencies.items():
+                if term not in run:
+                    run[term] = (array("I"), array("I"))
+                    run_bytes += TERM_OVERHEAD_BYTES
+                run[term][0].append(doc_id)
+                run[term][1].append(freq)
+                run_bytes += 2 * run[term][0].itemsize
+            if run_bytes >= budget_bytes:
+                run_paths.append(_spill_run(run, run_dir, len(run_paths)))
+                run, run_bytes = {}, 0
+        if len(doc_len) == 0:
+            raise ValueError("Cannot build postings from an empty corpus")
+
+        # the last run is merged straight from memory
+        runs = [_read_run(run_path) for run_path in run_paths]
+        runs.append(_sort_run(run, len(run_paths)))
+
+        corpus_size = len(doc_len)
+        doc_lengths = np.frombuffer(doc_len, dtype=np.uint32)
+        avgdl = int(doc_lengths.sum()) / corpus_size
+        terms, first_occurrences = {}, []
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(postings_path)}.", suffix=".tmp", dir=postings_dir)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                offset = 0
+                merged = heapq.merge(*runs, key=itemgetter(0))  # ties keep the run order, i.e. document order
+                for term, entries in itertools.groupby(merged, key=itemgetter(0)):
+                    doc_ids, freqs, first_occurrence = array("I"), array("I"), None
+                    for _, occurrence, run_doc_ids, run_freqs in entries:
+                        first_occurrence = first_occurrence or occurrence
+                        doc_ids.extend(run_doc_ids)
+                        freqs.extend(run_freqs)
+                    doc_ids = np.frombuffer(doc_ids, dtype=np.uint32)
+                    encoded_doc_ids = zlib.compress(np.diff(doc_ids, prepend=np.uint32(0)).tobytes())
+                    encoded_freqs = zlib.compress(freqs.tobytes())
+                    file.write(encoded_doc_ids)
+                    file.write(encoded_freqs)
+
+                    # the score of a posting is the idf times its weight, keep the range for the maximum score
+                    freqs = np.frombuffer(freqs, dtype=np.uint32)
+                    weights = freqs * (k1 + 1) / (freqs + k1 * (1 - b + b * doc_lengths[doc_ids] / avgdl))
+                    idf = math.log(corpus_size - len(doc_ids) + 0.5) - math.log(len(doc_ids) + 0.5)
+                    terms[term] = (offset, len(encoded_doc_ids), len(encoded_freqs), idf, weights.min(), weights.max())
+                    offset += len(encoded_doc_ids) + len(encoded_freqs)
+                    first_occurrences.append((first_occurrence, idf))
+                file.flush()
+                os.fsync(file.fileno())
+            _set_default_permissions(tmp_path)
+            os.replace(tmp_path, postings_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+    # sum the idfs in the same order as BM25Okapi so the floor is bit-identical
+    idf_sum = 0
+    for _, idf in sorted(first_occurrences):
+        idf_sum += idf
+    eps = epsilon * (idf_sum / max(1, len(terms)))
+    for term, (offset, doc_ids_length, freqs_length, idf, min_weight, max_weight) in terms.items():
+        if idf < 0:
+            idf = eps
+        max_score = float(idf * max_weight if idf >= 0 else idf * min_weight)
+        terms[term] = (offset, doc_ids_length, freqs_length, idf, max_score)
+
+    return DiskPostings(os.path.abspath(postings_path), terms, doc_lengths, avgdl, k1, b)
+
+
+class DiskPostings:
+    """
+    Read-only BM25 postings stored in a compressed file, decoded term by term on access.
+
+    Maps each term to the same ``Postings`` the in-memory BM25 index builds, keeping the
+    most recently used terms decoded up to a memory budget. Safe to query from several threads.
+    """
+    def __init__(self, postings_path: str, terms: dict, doc_len: np.ndarray, avgdl: float, k1: float, b: float, cache_mb: float = 256):
+        """
+        Initialize the DiskPostings class.
+
+        :param postings_path: The path of the postings file.
+        :type postings_path: str
+        :param terms: Each term's offset in the file, compressed document and frequency lengths, idf and maximum score.
+        :type terms: dict
+        :param doc_len: The length of each document.
+        :type doc_len: np.ndarray
+        :param avgdl: The average document length.
+        :type avgdl: float
+        :param k1: The BM25 term frequency saturation.
+        :type k1: float
+        :param b: The BM25 length normalization.
+        :type b: float
+        :param cache_mb: The memory for decoded terms, in megabytes.
+        :type cache_mb: float
+        """
+        self.postings_path = postings_path
+        self.terms = terms
+        self.doc_len = doc_len
+        self.avgdl = avgdl
+        self.k1 = k1
+        self.b = b
+        self.cache_mb = cache_mb
+        self._open()
+
+    def _open(self) -> None:
+        with open(self.postings_path, "rb") as file:
+            self._file = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(self.postings_path) > 0 else b""
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._lock = threading.Lock()
+
+    def move(self, postings_path: str) -> None:
+        """
+        Point to the postings file at a new path, e.g. after it was moved next to a snapshot.
+
+        :param postings_path: The new path of the postings file.
+        :type postings_path: str
+        """
+        self.postings_path = os.path.abspath(postings_path)
+        self._open()
+
+    def __getstate__(self) -> dict:
+        return {key: value for key, value in self.__dict__.items() if key[0] != "_"}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    def __contains__(self, term: str) -> bool:
+        return term in self.terms
+
+    def get_max_score(self, term: str) -> float:
+        """
+        Get the maximum score of a term in any document, without decoding its postings.
+
+        :param term: The term.
+        :type term: str
+        :return: The maximum score.
+        :rtype: float
+        """
+        return self.terms[term][4]
+
+    def __getitem__(self, term: str) -> Postings:
+        with self._lock:
+            term_postings = self._cache.get(term)
+            if term_postings is not None:
+                self._cache.move_to_end(term)
+                return term_postings
+
+        offset, doc_ids_length, freqs_length, idf, _ = self.terms[term]
+        doc_ids = np.cumsum(np.frombuffer(zlib.decompress(self._file[offset : offset + doc_ids_length]), dtype=np.uint32), dtype=np.int64)
+        offset += doc_ids_length
+        freqs = np.frombuffer(zlib.decompress(self._file[offset : offset + freqs_length]), dtype=np.uint32).astype(np.int64)
+        term_postings = get_term_postings(doc_ids, freqs, idf, self.doc_len[doc_ids].astype(np.int64), self.avgdl, self.k1, self.b)
+
+        size = _get_nbytes(term_postings)
+        with self._lock:
+            if term not in self._cache and size <= self.cache_mb * 1024 * 1024:
+                self._cache[term] = term_postings
+                self._cache_bytes += size
+                while self._cache_bytes > self.cache_mb * 1024 * 1024:
+                    _, evicted = self._cache.popitem(last=False)
+                    self._cache_bytes -= _get_nbytes(evicted)
+        return term_postings
+
+
+def _get_nbytes(term_postings: Postings) -> int:
+    return sum(values.nbytes for values in term_postings)
@@ -0,0 +1,265 @@
+import os
+import tempfile
+import threading
+import numpy as np
+from collections import OrderedDict
+from tqdm import tqdm
+from typing import List, Tuple, Any
+from sklearn.metrics.pairwise import cosine_similarity
+from .bm25 import BM25
+from .kv_store import KVStore
+from .kv_store import TextType
+from .kv_store import _link_snapshot_file
+from .kv_store import _set_default_permissions
+
+
+class TwoStage(BM25):
+    """
+    Two-stage index: BM25 candidate generation followed by dense rescoring.
+
+    Only the keys in the BM25 candidate pool are scored with the dense model, so
+    the dense cost scales with ``pool_size`` instead of the corpus size.
+    """
+    def __init__(self, index_name: str, dense_type: str = "e5", pool_size: int = 100, cache_size: int = 100000):
+        """
+        Initialize the TwoStage class.
+
+        :param index_name: The name of the index.
+        :type index_name: str
+        :param dense_type: The dense backend used for rescoring, "e5" or "gtr".
+        :type dense_type: str
+        :param pool_size: The number of BM25 candidates to rescore.
+        :type pool_size: int
+        :param cache_size: The number of key embeddings to keep in memory.
+        :type cache_size: int
+        """
+        super().__init__(index_name)
+        self.index_type = "twostage"
+        self.dense_type = dense_type
+        self.pool_size = pool_size
+        self.cache_size = cache_size
+        self.embeddings_path = None  # optional memory-mapped key embeddings
+        self._dense = self._initialize_dense()
+        self._embeddings = None
+        self._embedding_cache = OrderedDict()
+        self._embedding_lock = threading.Lock()  # queries may run in several threads
+
+    def _initialize_dense(self) -> KVStore:
+        """
+        Initialize the dense backend used for encoding.
+
+        :raises ValueError: If the dense type is not valid.
+        :return: The dense backend.
+        :rtype: KVStore
+        """
+        if self.dense_type == "e5":
+            from .e5 import E5
+
+            return E5(None)
+        elif self.dense_type == "gtr":
+            from .gtr import GTR
+
+            return GTR(None)
+        else:
+            raise ValueError("Invalid dense type, must be 'e5' or 'gtr'")
+
+    def _encode_batch(
+        self, texts: List[str], type: TextType, show_progress_bar: bool = True
+    ) -> List[Any]:
+        """
+        Encode a batch of texts.
+
+        Keys are encoded for BM25 only. Queries are encoded for both stages.
+
+        :param texts: The texts to encode.
+        :type texts: List[str]
+        :param type: The type of text.
+        :type type: TextType
+        :param show_progress_bar: Whether to show a progress bar.
+        :type show_progress_bar: bool
+        :return: The encoded texts.
+        :rtype: List[Any]
+        """
+        tokens_list = super()._encode_batch(texts, type, show_progress_bar=show_progress_bar)
+        if type == TextType.KEY:
+            return tokens_list
+        dense_list = self._dense._encode_batch(texts, type, show_progress_bar=False)
+        return list(zip(tokens_list, dense_list))
+
+    def _get_key_embeddings(self, indices: np.ndarray) -> np.ndarray:
+        """
+        Get the dense embeddings of the given keys.
+
+        Embeddings are read from the memory-mapped file if one was precomputed,
+        otherwise they are looked up in the in-memory cache and the missing ones
+        are encoded.
+
+        :param indices: The indices of the keys.
+        :type indices: np.ndarray
+        :return: The key embeddings, one row per index.
+        :rtype: np.ndarray
+        """
+        if self._embeddings is not None:
+            return np.asarray(self._embeddings[np.sort(indices)])[np.argsort(np.argsort(indices))]
+
+        with self._embedding_lock:
+            embeddings = {i: self._embedding_cache[i] for i in indices if i in self._embedding_cache}
+            for i in embeddings:
+                self._embedding_cache.move_to_end(i)
+        # encode outside the lock, the rows are copied out so later evictions cannot lose them
+        missing = [i for i in indices if i not in embeddings]
+        if len(missing) > 0:
+            encoded = self._dense._encode_batch([self.keys[i] for i in missing], TextType.KEY, show_progress_bar=False)
+            embeddings.update(zip(missing, encoded))
+            with self._embedding_lock:
+                for i, embedding in zip(missing, encoded):
+                    self._embedding_cache[i] = embedding
+                while len(self._embedding_cache) > self.cache_size:
+                    self._embedding_cache.popitem(last=False)
+        return np.stack([embeddings[i] for i in indices])
+
+    def _query(self, encoded_query: Tuple[List[str], Any], n: int) -> List[int]:
+        """
+        Query the index.
+
+        :param encoded_query: The BM25 tokens and dense embedding of the query.
+        :type encoded_query: Tuple[List[str], Any]
+        :param n: The number of results to return.
+        :type n: int
+        :return: The indices of the results.
+        :rtype: List[int]
+        """
+        tokens, embedding = encoded_query
+        return self._rescore(self._get_scores(tokens), embedding, n)
+
+    def _rescore(self, scores: np.ndarray, embedding: Any, n: int) -> List[int]:
+        """
+        Rescore the best BM25 candidates with the dense model.
+
+        :param scores: The BM25 scores of every key.
+        :type scores: np.ndarray
+        :param embedding: The dense embedding of the query.
+        :type embedding: Any
+        :param n: The number of results to return.
+        :type n: int
+        :return: The indices of the results.
+        :rtype: List[int]
+        """
+        pool_size = min(max(self.pool_size, n), len(scores))
+        candidates = np.argpartition(scores, -pool_size)[-pool_size:]
+
+        key_embeddings = self._get_key_embeddings(candidates)
+        cosine_similarities = cosine_similarity([embedding], key_embeddings)[0]
+        top_candidates = cosine_similarities.argsort()[-n:][::-1]
+        return candidates[top_candidates].tolist()
+
+    def _query_grouped(self, encoded_query: Tuple[List[str], Any], n: int, group_by: str, aggregate: str) -> List[int]:
+        """
+        Grouped queries are not supported, only the candidate pool is scored by the dense model.
+
+        :raises NotImplementedError: Always.
+        """
+        raise NotImplementedError("TwoStage indices do not support grouped queries")
+
+    def _query_budgeted(self, encoded_query: Tuple[List[str], Any], n: int, deadline: float) -> Tuple[List[int], bool]:
+        """
+        Query the index, generating candidates from the highest-impact query terms that fit in the budget.
+
+        The rescoring stage always runs, its cost is bounded by the pool size.
+
+        :param encoded_query: The BM25 tokens and dense embedding of the query.
+        :type encoded_query: Tuple[List[str], Any]
+        :param n: The number of results to return.
+        :type n: int
+        :param deadline: The ``time.perf_counter()`` value by which to return.
+        :type deadline: float
+        :return: The indices of the results, and whether the search stopped early.
+        :rtype: Tuple[List[int], bool]
+        """
+        tokens, embedding = encoded_query
+        scores, partial = self._get_scores_budgeted(tokens, deadline)
+        return self._rescore(scores, embedding, n), partial
+
+    def precompute_embeddings(self, embeddings_path: str, batch_size: int = 4096) -> None:
+        """
+        Encode every key and store the embeddings in a memory-mapped file.
+
+        Queries then read candidate embeddings from disk instead of encoding them. The file is
+        written under a temporary name and moved into place, so indices still mapping an older
+        file at the same path are unaffected.
+
+        :param embeddings_path: The path of the ``.npy`` file to write.
+        :type embeddings_path: str
+        :param batch_size: The number of keys to encode at a time.
+        :type batch_size: int
+        :raises ValueError: If the index is empty.
+        """
+        if len(self.keys) == 0:
+            raise ValueError("Cannot precompute embeddings of an empty index")
+        embeddings_path = os.path.abspath(embeddings_path)
+        os.makedirs(os.path.dirname(embeddings_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(embeddings_path)}.", suffix=".tmp", dir=os.path.dirname(embeddings_path))
+        os.close(fd)
+        try:
+            embeddings = None
+            for start in tqdm(range(0, len(self.keys), batch_size), desc=f"Encoding {self.index_name} keys"):
+                batch = self._dense._encode_batch(self.keys[start : start + batch_size], TextType.KEY, show_progress_bar=False)
+                if embeddings is None:
+                    embeddings = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float16, shape=(len(self.keys), batch.shape[1]))
+                embeddings[start : start + len(batch)] = batch
+            embeddings.flush()
+            del embeddings
+            _set_default_permissions(tmp_path)
+            os.replace(tmp_path, embeddings_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        self.embeddings_path = embeddings_path
+        self._embeddings = np.load(embeddings_path, mmap_mode="r")
+        with self._embedding_lock:
+            self._embedding_cache.clear()
+
+    def clear(self) -> None:
+        """
+        Clear the index.
+        """
+        super().clear()
+        self.embeddings_path = None
+        self._embeddings = None
+        with self._embedding_lock:
+            self._embedding_cache.clear()
+
+    def _save_snapshot_files(self, snapshot_dir: str, version: int) -> None:
+        """
+        Give the snapshot its own copy of the postings and of the precomputed key embeddings.
+
+        :param snapshot_dir: The snapshot directory.
+        :type snapshot_dir: str
+        :param version: The version of the new snapshot.
+        :type version: int
+        """
+        super()._save_snapshot_files(snapshot_dir, version)
+        if self.embeddings_path is None:
+            return
+        embeddings_path = os.path.abspath(os.path.join(snapshot_dir, f"{version:06d}.npy"))
+        if self.embeddings_path == embeddings_path:
+            return
+        _link_snapshot_file(self.embeddings_path, embeddings_path)
+        self.embeddings_path = embeddings_path
+        self._embeddings = np.load(embeddings_path, mmap_mode="r")
+
+    def load(self, dir_name: str) -> None:
+        """
+        Load the index from disk.
+
+        :param dir_name: The directory to load the index from.
+        :type dir_name: str
+        """
+        super().load(dir_name)
+        if self._dense.index_type != self.dense_type:
+            self._dense = self._initialize_dense()
+        if self.embeddings_path is not None:
+            self._embeddings = np.load(self.embeddings_path, mmap_mode="r")
+        return self
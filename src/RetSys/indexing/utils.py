@@ -1,5 +1,6 @@
 import os
-from typing import List, Any, Tuple
+import json
+from typing import List, Iterator, Any, Tuple
 from datasets import Dataset
 import spacy
 from spacy.pipeline import Sentencizer
@@ -57,10 +58,33 @@ def get_clean_paragraphs(item: dict, min_words: int = 10) -> List[str]:
     return paragraphs
 
 
-def get_clean_propositions(data: List[dict], batch_size: int = 16) -> List[str]:
+def get_clean_paragraph_columns(batch: dict, min_words: int = 10) -> dict:
+    """
+    Split a batch of records into paragraph key and location columns.
+
+    Meant for ``Dataset.map(batched=True)``, so the corpus is processed as Arrow batches
+    rather than one Python dict per record.
+    """
+    if "page_number" in batch:
+        corpusids = [f"{file_name}_page_{page_number}" for file_name, page_number in zip(batch["file_name"], batch["page_number"])]
+    else:
+        corpusids = batch["file_name"]
+
+    columns = {"key": [], "corpusid": [], "position": []}
+    for corpusid, doc in zip(corpusids, nlp.pipe(batch["document"])):
+        paragraphs = [str(sent) for sent in doc.sents]
+        paragraphs = [
+            paragraph for paragraph in paragraphs if len(paragraph.split()) >= min_words
+        ]
+        columns["key"].extend(paragraphs)
+        columns["corpusid"].extend([corpusid] * len(paragraphs))
+        columns["position"].extend(range(len(paragraphs)))
+    return columns
+
+
+def _propositionize(data: List[dict], batch_size: int = 16) -> Iterator[List[Tuple[str, str]]]:
     from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
     import torch
-    import json
 
     model_name = "chentong00/propositionizer-wiki-flan-t5-large"
     device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -74,16 +98,41 @@ def get_clean_propositions(data: List[dict], batch_size: int = 16) -> List[str]:
         outputs = model.generate(input_ids.to(device), max_new_tokens=512)
         return tokenizer.batch_decode(outputs, skip_special_tokens=True)
 
-    propositions = []
+    # yields the paragraphs of each record with the propositionizer output of each
     for record in tqdm(data, position=0, leave=True):
         paragraphs = get_clean_paragraphs(record)
+        paragraph_outputs = []
         for i in tqdm(range(0, len(paragraphs), batch_size), position=1, leave=False):
             batch = paragraphs[i : i + batch_size]
-            batch_outputs = process_batch(batch)
-            propositions.extend(batch_outputs)
+            paragraph_outputs.extend(zip(batch, process_batch(batch)))
+        yield paragraph_outputs
+
+
+def _parse_propositions(output: str) -> List[str]:
+    # the propositionizer writes a JSON list of propositions per paragraph
+    try:
+        propositions = json.loads(output)
+    except json.JSONDecodeError:
+        return [output]
+    if not isinstance(propositions, list):
+        return [output]
+    return [str(proposition) for proposition in propositions]
+
+
+def get_clean_propositions(data: List[dict], batch_size: int = 16) -> List[str]:
+    propositions = []
+    for paragraph_outputs in _propositionize(data, batch_size):
+        propositions.extend(output for _, output in paragraph_outputs)
     return propositions
 
 
+def get_clean_paragraph_propositions(data: List[dict], batch_size: int = 16) -> List[List[Tuple[str, List[str]]]]:
+    return [
+        [(paragraph, _parse_propositions(output)) for paragraph, output in paragraph_outputs]
+        for paragraph_outputs in _propositionize(data, batch_size)
+    ]
+
+
 def get_clean_dict(data: Dataset) -> dict:
     return {get_clean_corpusid(item): item for item in data}
 